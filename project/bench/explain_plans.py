@@ -0,0 +1,226 @@
+import argparse
+import ast
+import asyncio
+import json
+import re
+import sys
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from pathlib import Path
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from seed import BENCH_USERS, DATABASE_URL, add_seed_arguments, bench_email, seed
+
+SOURCE_DIR = Path(__file__).resolve().parent.parent / "src"
+
+# Modules whose text() statements are checked
+MODULES = ["main.py", "authorization.py", "catalog.py", "queries.py", "session_purge.py", "rate_limit.py", "sales.py"]
+
+HOT_TABLES = {"users", "sessions", "products", "cart", "orders", "order_items"}
+
+# Statements that read the whole table on purpose
+ALLOWED_SEQ_SCANS = {
+    "select id, name, description, price from products order by id",
+    "delete from product_sales_daily where product_id in (select id from products)",
+}
+
+# Statements using an extension that the migrations only install where the server ships it
+OPTIONAL_EXTENSIONS = {"word_similarity(": "pg_trgm"}
+
+BIND_PARAMETER = re.compile(r"(?<![:\w\\]):(\w+)(?!:)")
+SQL_STATEMENT = re.compile(r"\s*(select|insert|update|delete|with)\s", re.IGNORECASE)
+
+
+def _module_constants(tree: ast.Module, constants: dict[str, str]) -> dict[str, int]:
+    """Resolves module level string constants into constants and returns the line of every one of them."""
+    lines = {}
+
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            # A dict of statements is stored as NAME[key] entries
+            if isinstance(node.value, ast.Dict):
+                values = {f"[{key.value!r}]": _resolve(value, constants) for key, value in zip(node.value.keys, node.value.values)
+                          if isinstance(key, ast.Constant)}
+            else:
+                values = {"": _resolve(node.value, constants)}
+
+            for target in node.targets:
+                if not isinstance(target, ast.Name):
+                    continue
+
+                for suffix, value in values.items():
+                    if value is not None:
+                        constants[target.id + suffix] = value
+                        lines[target.id + suffix] = node.lineno
+
+    return lines
+
+
+def _resolve(node: ast.AST, constants: dict[str, str]) -> str | None:
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if isinstance(node, ast.Name):
+        return constants.get(node.id)
+    if isinstance(node, ast.FormattedValue) and node.conversion == -1 and node.format_spec is None:
+        return _resolve(node.value, constants)
+    if isinstance(node, ast.JoinedStr):
+        parts = [_resolve(value, constants) for value in node.values]
+        return None if None in parts else "".join(parts)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left, right = _resolve(node.left, constants), _resolve(node.right, constants)
+        return None if left is None or right is None else left + right
+
+    return None
+
+
+def collect_statements():
+    """Returns (location, sql) of every text() statement in MODULES and the locations of statements built at runtime."""
+    trees = {module: ast.parse((SOURCE_DIR / module).read_text(encoding="utf-8")) for module in MODULES}
+
+    constants = {}
+    statements, dynamic = [], []
+
+    for module, tree in trees.items():
+        for name, line in _module_constants(tree, constants).items():
+            if SQL_STATEMENT.match(constants[name]):
+                statements.append((f"{module}:{line}", " ".join(constants[name].split())))
+
+    for module, tree in trees.items():
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call) or not node.args:
+                continue
+            if not (isinstance(node.func, ast.Name) and node.func.id == "text" or isinstance(node.func, ast.Attribute) and node.func.attr == "text"):
+                continue
+
+            location = f"{module}:{node.lineno}"
+            argument = node.args[0]
+
+            # Module level statements are already collected
+            if isinstance(argument, ast.Name) and argument.id in constants:
+                continue
+            if isinstance(argument, ast.Subscript) and isinstance(argument.value, ast.Name) and any(
+                    name.startswith(argument.value.id + "[") for name in constants):
+                continue
+
+            sql = _resolve(argument, constants)
+            if sql is None:
+                dynamic.append(location)
+            else:
+                statements.append((location, " ".join(sql.split())))
+
+    return statements, dynamic
+
+
+def sequential_scans(plan: dict) -> list[str]:
+    found = []
+
+    if plan.get("Node Type") == "Seq Scan" and plan.get("Relation Name") in HOT_TABLES:
+        found.append(plan["Relation Name"])
+
+    for child in plan.get("Plans", []):
+        found.extend(sequential_scans(child))
+
+    return found
+
+
+async def sample_parameters(connection) -> dict:
+    user_id = (await connection.execute(text(f"select ids[1] from ({BENCH_USERS}) u"))).scalar()
+    product_id = (await connection.execute(text("select min(id) from products"))).scalar()
+    order_id = (await connection.execute(text("select min(id) from orders where user_id = :user_id"), {"user_id": user_id})).scalar()
+    expires_at = datetime.now(timezone.utc) + timedelta(days=1)
+
+    # A batch in the middle of the history, aligned like the batches of the backfill, so its plan is the one a real batch gets
+    sys.path.insert(0, str(SOURCE_DIR))
+    from sales import LAST_ORDER_ID, SALES_BACKFILL_BATCH_SIZE
+
+    last_order_id = (await connection.execute(text(LAST_ORDER_ID))).scalar()
+    batches = -(-last_order_id // SALES_BACKFILL_BATCH_SIZE)
+    after_id = batches // 2 * SALES_BACKFILL_BATCH_SIZE
+
+    return {
+        "id": user_id, "user_id": user_id, "sub": user_id, "product_id": product_id, "order_id": order_id,
+        "email": bench_email(1), "token": "0" * 32, "jti": "0" * 32, "expires_at": expires_at,
+        "name": "Тест", "surname": "Тестов", "middle_name": None, "set_fio": True, "fio": "Тест Тестов", "password": "hash",
+        "password_hash": "hash", "avatar": "/avatars/default.jpg", "description": "Описание", "price": Decimal("100.00"),
+        "min_price": Decimal("10.00"), "max_price": Decimal("1000.00"), "limit": 50, "idempotency_key": "key",
+        "quantity": 1, "max_quantity": 1000, "product_ids": [product_id], "quantities": [1], "before_id": 2 ** 31 - 1, "keep_sessions": 19,
+        "batch_size": 1000, "query": "термос", "offset": 0,
+        "key": "address:127.0.0.1", "burst": 30, "rate": 0.5, "refill_seconds": 60.0,
+        "date_from": date.today() - timedelta(days=29), "date_to": date.today(), "after_id": after_id,
+        # Orders that fit in one batch are read whole by the backfill, there is no range plan to check
+        "last_id": min(after_id + SALES_BACKFILL_BATCH_SIZE, last_order_id) if batches > 1 else None,
+    }
+
+
+async def check_plans(args) -> int:
+    engine = create_async_engine(DATABASE_URL)
+    statements, dynamic = collect_statements()
+    failures = 0
+
+    async with engine.connect() as connection:
+        if args.seed:
+            await seed(connection, args.users, args.products, args.cart_rows, args.orders, args.sessions)
+
+        params = await sample_parameters(connection)
+        installed = set((await connection.execute(text("select extname from pg_extension"))).scalars())
+        unavailable, single_batch = [], []
+
+        for location, sql in statements:
+            needed = {extension for marker, extension in OPTIONAL_EXTENSIONS.items() if marker in sql} - installed
+            if needed:
+                unavailable.append((location, needed))
+                continue
+
+            names = set(BIND_PARAMETER.findall(sql))
+            if "last_id" in names and params["last_id"] is None:
+                single_batch.append(location)
+                continue
+
+            missing = names - params.keys()
+            if missing:
+                print(f"FAIL {location}: no sample value for {', '.join(sorted(missing))}")
+                failures += 1
+                continue
+
+            try:
+                plan = (await connection.execute(text("explain (format json) " + sql), {name: params[name] for name in names})).scalar()
+            except DBAPIError as e:
+                await connection.rollback()
+                print(f"FAIL {location}: {e.orig}\n     {sql}")
+                failures += 1
+                continue
+
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+
+            scans = sequential_scans(plan[0]["Plan"])
+            await connection.rollback()
+
+            if scans and sql not in ALLOWED_SEQ_SCANS:
+                print(f"FAIL {location}: sequential scan on {', '.join(scans)}\n     {sql}")
+                failures += 1
+            else:
+                print(f"ok   {location}")
+
+    await engine.dispose()
+
+    for location in dynamic:
+        print(f"skip {location}: statement is built at runtime")
+    for location in single_batch:
+        print(f"skip {location}: all orders fit in one backfill batch, seed more than SALES_BACKFILL_BATCH_SIZE to check it")
+    for location, needed in unavailable:
+        print(f"skip {location}: {', '.join(sorted(needed))} is not installed")
+
+    print(f"{len(statements) - len(unavailable) - len(single_batch)} statements checked, {failures} failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fails if any SQL statement of the API falls back to a sequential scan on a hot table")
+    parser.add_argument("--seed", action="store_true", help="seed the database before checking plans")
+    add_seed_arguments(parser)
+
+    sys.exit(asyncio.run(check_plans(parser.parse_args())))
@@ -0,0 +1,203 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from seed import BENCH_PASSWORD, DATABASE_URL, PRODUCT_IDS, add_seed_arguments, bench_email, seed
+
+SOURCE_DIR = Path(__file__).resolve().parent.parent / "src"
+
+COUNT_BENCH_USERS = "select count(*) from users where email like 'bench%@bench.local'"
+
+
+class Recorder:
+    """Collects latencies per endpoint, observations before the warmup ends are dropped."""
+
+    def __init__(self, warmup_until: float):
+        self.warmup_until = warmup_until
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+
+    async def request(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, expected=(200,), **kwargs) -> httpx.Response | None:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            response = None
+        elapsed = time.perf_counter() - started
+
+        if started >= self.warmup_until:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            if response is None or response.status_code not in expected:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+        return response if response is not None and response.status_code in expected else None
+
+
+def percentile(values: list[float], share: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[max(int(len(values) * share + 0.999999) - 1, 0)]
+
+
+def summarize(latencies: list[float], errors: int, duration: float) -> dict:
+    latencies = sorted(latencies)
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / duration, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+
+async def journey(client: httpx.AsyncClient, recorder: Recorder, rng: random.Random, args, bench_users: int, product_ids: list[int]):
+    """One visit of a customer: signs up or logs in, browses the catalog, fills the cart, checks out and looks at the history."""
+    if rng.random() < args.signup_share:
+        response = await recorder.request(client, "POST /signup", "POST", "/signup", json={
+            "email": f"load-{uuid.uuid4().hex}@{args.signup_domain}", "password": BENCH_PASSWORD, "fio": "Нагрузочный Тест"})
+        token = response.json()["user_token"] if response is not None else None
+    else:
+        email = bench_email(rng.randint(1, bench_users))
+        response = await recorder.request(client, "POST /login", "POST", "/login", json={"email": email, "password": BENCH_PASSWORD})
+        token = response.json()["user_token"] if response is not None else None
+
+    if token is None:
+        return
+
+    headers = {"Authorization": f"Bearer {token}"}
+
+    response = await recorder.request(client, "GET /products?limit", "GET", "/products", params={"limit": args.page_size, "sort": "price"})
+    if response is not None and response.json()["next_cursor"] is not None:
+        await recorder.request(client, "GET /products?limit", "GET", "/products",
+                               params={"limit": args.page_size, "sort": "price", "cursor": response.json()["next_cursor"]})
+
+    for _ in range(args.cart_items):
+        await recorder.request(client, "POST /cart/{product_id}", "POST", f"/cart/{rng.choice(product_ids)}", headers=headers)
+
+    await recorder.request(client, "GET /cart", "GET", "/cart", headers=headers)
+    await recorder.request(client, "POST /order", "POST", "/order", headers={**headers, "Idempotency-Key": uuid.uuid4().hex}, expected=(200, 400))
+    await recorder.request(client, "GET /order?limit", "GET", "/order", headers=headers, params={"limit": 20})
+
+
+async def virtual_user(number: int, client: httpx.AsyncClient, recorder: Recorder, args, bench_users: int, product_ids: list[int], deadline: float):
+    rng = random.Random(args.random_seed * 100_003 + number)
+
+    while time.perf_counter() < deadline:
+        await journey(client, recorder, rng, args, bench_users, product_ids)
+
+
+def start_server(args) -> subprocess.Popen:
+    # Every virtual user connects from the same address, so only the per-email login limit is kept; signups do not
+    # look up the domain of their email, so the run does not depend on DNS
+    env = {**os.environ, "DATABASE_URL": DATABASE_URL, "HOST": "127.0.0.1", "PORT": str(args.port), "RATE_LIMIT_IP_PER_MINUTE": "0",
+           "EMAIL_CHECK_DELIVERABILITY": "false"}
+    return subprocess.Popen([sys.executable, "app.py"], cwd=SOURCE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_for_server(client: httpx.AsyncClient, timeout: float):
+    deadline = time.perf_counter() + timeout
+
+    while True:
+        try:
+            if (await client.get("/api/health")).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+
+        if time.perf_counter() > deadline:
+            raise RuntimeError("the API did not start in time")
+        await asyncio.sleep(0.2)
+
+
+def git_commit(source_dir: Path = SOURCE_DIR) -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=source_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    engine = create_async_engine(DATABASE_URL)
+
+    async with engine.connect() as connection:
+        if args.seed:
+            await seed(connection, args.users, args.products, args.cart_rows, args.orders, args.sessions)
+
+        bench_users = (await connection.execute(text(COUNT_BENCH_USERS))).scalar()
+        product_ids = (await connection.execute(text(PRODUCT_IDS))).scalar()
+
+    await engine.dispose()
+
+    if not bench_users or not product_ids:
+        raise RuntimeError("the database has no bench users or products, run with --seed")
+
+    server = start_server(args) if args.url is None else None
+    base_url = args.url or f"http://127.0.0.1:{args.port}"
+
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=args.timeout) as client:
+            await wait_for_server(client, args.startup_timeout)
+
+            started = time.perf_counter()
+            recorder = Recorder(started + args.warmup)
+            deadline = started + args.warmup + args.duration
+
+            await asyncio.gather(*(virtual_user(number, client, recorder, args, bench_users, product_ids, deadline) for number in range(args.concurrency)))
+            duration = time.perf_counter() - recorder.warmup_until
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    endpoints = {endpoint: summarize(latencies, recorder.errors.get(endpoint, 0), duration) for endpoint, latencies in sorted(recorder.latencies.items())}
+    all_latencies = [latency for latencies in recorder.latencies.values() for latency in latencies]
+
+    return {
+        "commit": git_commit(),
+        "config": {"concurrency": args.concurrency, "duration": args.duration, "warmup": args.warmup, "signup_share": args.signup_share,
+                   "cart_items": args.cart_items, "page_size": args.page_size, "random_seed": args.random_seed, "bench_users": bench_users},
+        "total": summarize(all_latencies, sum(recorder.errors.values()), duration) if all_latencies else None,
+        "endpoints": endpoints,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs customer journeys against the API at a fixed concurrency and prints latency percentiles per endpoint as JSON")
+    parser.add_argument("--seed", action="store_true", help="seed the database before the run")
+    parser.add_argument("--url", help="URL of an already running API, by default app.py is started on --port")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--concurrency", type=int, default=32, help="number of customers running journeys at the same time")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds before measuring starts")
+    parser.add_argument("--signup-share", type=float, default=0.1, help="share of journeys that start with a signup instead of a login")
+    # A reserved domain without mail servers, a server given in --url has to run with EMAIL_CHECK_DELIVERABILITY=false
+    parser.add_argument("--signup-domain", default="example.com")
+    parser.add_argument("--cart-items", type=int, default=3)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--random-seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--output", help="write the report to this file instead of stdout")
+    add_seed_arguments(parser)
+
+    args = parser.parse_args()
+    report = json.dumps(asyncio.run(run(args)), indent=2, ensure_ascii=False)
+
+    if args.output:
+        Path(args.output).write_text(report + "\n", encoding="utf-8")
+    else:
+        print(report)
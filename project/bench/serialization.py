@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import JSON, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.responses import JSONResponse
+
+from load_test import SOURCE_DIR, git_commit
+from seed import DATABASE_URL
+
+sys.path.insert(0, str(SOURCE_DIR))
+
+from serialization import ORJSONResponse  # noqa: E402
+
+LISTINGS = {
+    "products": "select id, name, description, price from products order by id limit :rows",
+    "orders": (
+        "select orders.id, orders.order_price, (select json_agg(json_build_object('product_id', product_id, 'name', name, "
+        "'unit_price', unit_price, 'quantity', quantity) order by id) from order_items where order_id = orders.id) as items "
+        "from orders order by id desc limit :rows"
+    ),
+}
+
+
+def generic_response(rows) -> bytes:
+    """What a handler returning [row._asdict() for row in rows] costs: jsonable_encoder and then json.dumps."""
+    return JSONResponse(jsonable_encoder([row._asdict() for row in rows])).body
+
+
+def fast_response(rows) -> bytes:
+    return ORJSONResponse(rows).body
+
+
+def cpu_per_call(function, rows, repeat: int) -> float:
+    started = time.process_time()
+    for _ in range(repeat):
+        function(rows)
+
+    return (time.process_time() - started) / repeat
+
+
+async def run(args) -> dict:
+    engine = create_async_engine(DATABASE_URL)
+    results = {}
+
+    async with engine.connect() as connection:
+        for name, statement in LISTINGS.items():
+            rows = (await connection.execute(text(statement).columns(items=JSON), {"rows": args.rows})).all()
+
+            if json.loads(generic_response(rows)) != json.loads(fast_response(rows)):
+                raise RuntimeError(f"{name}: the responses differ")
+
+            generic = cpu_per_call(generic_response, rows, args.repeat)
+            fast = cpu_per_call(fast_response, rows, args.repeat)
+            results[name] = {
+                "rows": len(rows),
+                "generic_ms": round(generic * 1000, 3),
+                "orjson_ms": round(fast * 1000, 3),
+                "speedup": round(generic / fast, 1),
+            }
+
+    await engine.dispose()
+    return {"commit": git_commit(), "listings": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares CPU time of rendering list responses through jsonable_encoder and through orjson")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=200)
+
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
@@ -0,0 +1,58 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from load_test import SOURCE_DIR, git_commit
+from seed import DATABASE_URL
+
+
+def time_to_first_request(args) -> float:
+    """Seconds from starting the server process to the first successful response of args.path."""
+    env = {**os.environ, "DATABASE_URL": DATABASE_URL, "HOST": "127.0.0.1", "PORT": str(args.port)}
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "app.py", "serve"], cwd=SOURCE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{args.port}", timeout=args.timeout) as client:
+            while True:
+                if server.poll() is not None:
+                    raise RuntimeError("the API exited during startup, is the database migrated?")
+
+                try:
+                    if client.get(args.path).status_code == 200:
+                        return time.perf_counter() - started
+                except httpx.TransportError:
+                    pass
+
+                if time.perf_counter() - started > args.timeout:
+                    raise RuntimeError("the API did not start in time")
+                time.sleep(0.005)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how long app.py takes from process start to its first served request")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8098)
+    parser.add_argument("--path", default="/products", help="first request, it should touch the database")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    timings = [time_to_first_request(args) * 1000 for _ in range(args.runs)]
+
+    print(json.dumps({
+        "commit": git_commit(),
+        "path": args.path,
+        "runs": args.runs,
+        "min_ms": round(min(timings), 1),
+        "median_ms": round(statistics.median(timings), 1),
+        "max_ms": round(max(timings), 1),
+    }, indent=2))
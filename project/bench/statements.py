@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import sys
+import uuid
+from pathlib import Path
+
+from load_test import SOURCE_DIR, git_commit
+from seed import BENCH_PASSWORD, DATABASE_URL, bench_email
+
+
+class Counter:
+    """Counts the statements, transactions and commits the API sends to the primary database."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.statements = self.transactions = self.commits = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._statement)
+        event.listen(engine.sync_engine, "begin", self._begin)
+        event.listen(engine.sync_engine, "commit", self._commit)
+
+    def _statement(self, *_):
+        self.statements += 1
+
+    def _begin(self, *_):
+        self.transactions += 1
+
+    def _commit(self, *_):
+        self.commits += 1
+
+    def snapshot(self) -> tuple[int, int, int]:
+        return self.statements, self.transactions, self.commits
+
+
+def scenarios(product: dict, admin_email: str):
+    """(name, setup, request) of every measured request; setup runs before each request and is not counted."""
+    product_id = product["id"]
+
+    def fill_cart(client, headers):
+        client.post(f"/cart/{product_id}", headers=headers)
+
+    def nothing(client, headers):
+        pass
+
+    return [
+        ("POST /signup", nothing, lambda client, headers: client.post("/signup", json={
+            "email": f"statements-{uuid.uuid4().hex}@example.com", "password": BENCH_PASSWORD, "fio": "Счётчик Запросов"})),
+        ("POST /login", nothing, lambda client, headers: client.post("/login", json={"email": bench_email(1), "password": BENCH_PASSWORD})),
+        ("PATCH /profile", nothing, lambda client, headers: client.patch("/profile", headers=headers, json={"fio": "Админ Админов", "email": admin_email})),
+        ("PATCH /product/{id}", nothing, lambda client, headers: client.patch(f"/product/{product_id}", headers=headers, json={
+            "name": product["name"], "description": product["description"], "price": product["price"]})),
+        ("POST /cart/{id}", nothing, lambda client, headers: client.post(f"/cart/{product_id}", headers=headers)),
+        ("GET /cart", nothing, lambda client, headers: client.get("/cart", headers=headers)),
+        ("POST /order", fill_cart, lambda client, headers: client.post("/order", headers=headers)),
+        ("POST /batch", nothing, lambda client, headers: client.post("/batch", headers=headers, json={"atomic": True, "operations": [
+            {"op": "add_to_cart", "product_id": product_id, "quantity": 1}, {"op": "get_cart"}, {"op": "place_order"}]})),
+    ]
+
+
+def run(args) -> dict:
+    source = Path(args.source).resolve()
+    os.environ["DATABASE_URL"] = DATABASE_URL
+    os.environ["RATE_LIMIT_IP_PER_MINUTE"] = "0"
+    os.environ["RATE_LIMIT_EMAIL_PER_MINUTE"] = "0"
+    os.chdir(source)
+    sys.path.insert(0, str(source))
+
+    # Signup checks that the email domain accepts mail, which needs DNS and is not what is measured here
+    import email_validator
+    email_validator.CHECK_DELIVERABILITY = False
+
+    from fastapi.testclient import TestClient
+    from database import engine
+    from main import app
+
+    counter = Counter(engine)
+    results = {}
+
+    with TestClient(app) as client:
+        admin = client.post("/login", json={"email": args.admin_email, "password": args.admin_password}).json()["user_token"]
+        headers = {"Authorization": f"Bearer {admin}"}
+        product = client.get("/products").json()[0]
+
+        for name, setup, request in scenarios(product, args.admin_email):
+            # The first request warms the caches of the API, as on a server that has been running for a while
+            setup(client, headers)
+            request(client, headers)
+
+            totals = [0, 0, 0]
+            for _ in range(args.repeat):
+                setup(client, headers)
+                before = counter.snapshot()
+                response = request(client, headers)
+                if response.status_code >= 400:
+                    raise RuntimeError(f"{name} failed with {response.status_code}: {response.text}")
+
+                for i, (start, end) in enumerate(zip(before, counter.snapshot())):
+                    totals[i] += end - start
+
+            results[name] = {key: round(total / args.repeat, 2) for key, total in zip(("statements", "transactions", "commits"), totals)}
+
+    return {"commit": git_commit(source), "source": str(source), "requests": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Counts the SQL statements and commits every API request sends to the database")
+    parser.add_argument("--source", default=str(SOURCE_DIR), help="API sources to measure, e.g. a worktree of an older commit")
+    parser.add_argument("--admin-email", default="admin@shop.ru")
+    parser.add_argument("--admin-password", default="QWEasd123")
+    parser.add_argument("--repeat", type=int, default=20)
+
+    print(json.dumps(run(parser.parse_args()), indent=2, ensure_ascii=False))
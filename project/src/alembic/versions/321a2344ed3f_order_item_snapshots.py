@@ -0,0 +1,50 @@
+"""order item snapshots
+
+Revision ID: 321a2344ed3f
+Revises: e5d1ac2b3a59
+Create Date: 2026-10-17 22:52:40.118573
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '321a2344ed3f'
+down_revision: Union[str, Sequence[str], None] = 'e5d1ac2b3a59'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.execute("alter table order_items add column if not exists name varchar(255)")
+    op.execute("alter table order_items add column if not exists unit_price decimal(10, 2)")
+
+    # Past prices are unknown, the current ones are the best available snapshot
+    op.execute("""update order_items set name = products.name, unit_price = products.price
+        from products where order_items.product_id = products.id and order_items.name is null""")
+
+    op.execute("alter table order_items alter column name set not null")
+    op.execute("alter table order_items alter column unit_price set not null")
+
+    # History no longer needs the product row, so products that were ordered can be deleted
+    op.execute("alter table order_items alter column product_id drop not null")
+    op.execute("alter table order_items drop constraint if exists order_items_product_id_fkey")
+    op.execute("alter table order_items add constraint order_items_product_id_fkey foreign key (product_id) references products(id) on delete set null")
+
+    with op.get_context().autocommit_block():
+        op.execute("create index concurrently if not exists orders_user_id_id_idx on orders (user_id, id)")
+        op.execute("drop index concurrently if exists orders_user_id_idx")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute("create index concurrently if not exists orders_user_id_idx on orders (user_id)")
+        op.execute("drop index concurrently if exists orders_user_id_id_idx")
+
+    op.execute("alter table order_items drop constraint if exists order_items_product_id_fkey")
+    op.execute("alter table order_items add constraint order_items_product_id_fkey foreign key (product_id) references products(id)")
+    op.execute("alter table order_items drop column unit_price")
+    op.execute("alter table order_items drop column name")
@@ -0,0 +1,37 @@
+"""foreign key indexes
+
+Revision ID: 3538684b8178
+Revises: b8143b3a99ef
+Create Date: 2026-10-17 21:52:09.640318
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3538684b8178'
+down_revision: Union[str, Sequence[str], None] = 'b8143b3a99ef'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+indexes = {
+    "cart_user_id_idx": "cart (user_id)",
+    "orders_user_id_idx": "orders (user_id)",
+    "order_items_order_id_idx": "order_items (order_id)",
+    "sessions_user_id_idx": "sessions (user_id)",
+}
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, columns in indexes.items():
+            op.execute(f"create index concurrently if not exists {name} on {columns}")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name in indexes:
+            op.execute(f"drop index concurrently if exists {name}")
@@ -0,0 +1,33 @@
+"""rate limit buckets
+
+Revision ID: 8bf921527ad6
+Revises: a8360f9170b1
+Create Date: 2026-10-17 23:59:12.604417
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8bf921527ad6'
+down_revision: Union[str, Sequence[str], None] = 'a8360f9170b1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    # Shared between the workers when RATE_LIMIT_SHARED is on; losing the buckets on a crash only resets the limits
+    op.execute("""create unlogged table if not exists rate_limit_buckets (
+        key varchar(300) primary key,
+        tokens double precision not null,
+        updated_at timestamptz not null,
+        expires_at timestamptz not null
+    );""")
+    op.execute("create index if not exists rate_limit_buckets_expires_at_idx on rate_limit_buckets (expires_at)")
+
+
+def downgrade():
+    op.execute("DROP TABLE rate_limit_buckets")
@@ -0,0 +1,42 @@
+"""session expiry
+
+Revision ID: 95b22ebc7664
+Revises: 321a2344ed3f
+Create Date: 2026-10-17 23:31:05.191681
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '95b22ebc7664'
+down_revision: Union[str, Sequence[str], None] = '321a2344ed3f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+indexes = {
+    "sessions_expires_at_idx": "sessions (expires_at)",
+    "revoked_tokens_expires_at_idx": "revoked_tokens (expires_at)",
+}
+
+
+def upgrade():
+    # Legacy sessions never expired, they get the lifetime of a new token from now on
+    op.execute("update sessions set expires_at = now() + interval '30 days' where expires_at is null")
+    op.execute("alter table sessions alter column expires_at set not null")
+
+    with op.get_context().autocommit_block():
+        for name, columns in indexes.items():
+            op.execute(f"create index concurrently if not exists {name} on {columns}")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name in indexes:
+            op.execute(f"drop index concurrently if exists {name}")
+
+    op.execute("alter table sessions alter column expires_at drop not null")
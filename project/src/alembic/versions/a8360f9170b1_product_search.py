@@ -0,0 +1,43 @@
+"""product search
+
+Revision ID: a8360f9170b1
+Revises: 95b22ebc7664
+Create Date: 2026-10-17 23:58:41.502113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a8360f9170b1'
+down_revision: Union[str, Sequence[str], None] = '95b22ebc7664'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    # Names weigh more than descriptions in the rank; adding a stored column rewrites the table once
+    op.execute("""alter table products add column if not exists search_vector tsvector generated always as (
+        setweight(to_tsvector('russian', coalesce(name, '')), 'A') || setweight(to_tsvector('russian', coalesce(description, '')), 'B')
+    ) stored""")
+
+    # Typo tolerant matching needs pg_trgm, search falls back to full text only where the extension is not shipped
+    trigram = op.get_bind().execute(sa.text("select 1 from pg_available_extensions where name = 'pg_trgm'")).scalar()
+    if trigram:
+        op.execute("create extension if not exists pg_trgm")
+
+    with op.get_context().autocommit_block():
+        op.execute("create index concurrently if not exists products_search_vector_idx on products using gin (search_vector)")
+        if trigram:
+            op.execute("create index concurrently if not exists products_name_trgm_idx on products using gin (name gin_trgm_ops)")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute("drop index concurrently if exists products_name_trgm_idx")
+        op.execute("drop index concurrently if exists products_search_vector_idx")
+
+    op.execute("alter table products drop column if exists search_vector")
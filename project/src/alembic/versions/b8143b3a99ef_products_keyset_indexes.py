@@ -0,0 +1,29 @@
+"""products keyset indexes
+
+Revision ID: b8143b3a99ef
+Revises: c56e5baac75b
+Create Date: 2026-10-17 21:31:47.905112
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8143b3a99ef'
+down_revision: Union[str, Sequence[str], None] = 'c56e5baac75b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    # Pages sorted by price walk (price, id) in both directions, pages sorted by id use the primary key
+    with op.get_context().autocommit_block():
+        op.execute("create index concurrently if not exists products_price_id_idx on products (price, id)")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute("drop index concurrently if exists products_price_id_idx")
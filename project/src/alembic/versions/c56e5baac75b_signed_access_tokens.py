@@ -0,0 +1,33 @@
+"""signed access tokens
+
+Revision ID: c56e5baac75b
+Revises: 7eda90400a02
+Create Date: 2026-10-17 21:04:12.318094
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c56e5baac75b'
+down_revision: Union[str, Sequence[str], None] = '7eda90400a02'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    # Rows of signed tokens keep the token jti, legacy rows keep the whole bcrypt token and never expire
+    op.execute("alter table sessions add column if not exists expires_at timestamptz")
+
+    op.execute("""create table if not exists revoked_tokens (
+        jti varchar(64) primary key,
+        expires_at timestamptz not null
+    );""")
+
+
+def downgrade():
+    op.execute("DROP TABLE revoked_tokens")
+    op.execute("alter table sessions drop column expires_at")
@@ -0,0 +1,46 @@
+"""cart quantities
+
+Revision ID: e5d1ac2b3a59
+Revises: f41c2f106cfe
+Create Date: 2026-10-17 22:31:05.781240
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5d1ac2b3a59'
+down_revision: Union[str, Sequence[str], None] = 'f41c2f106cfe'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.execute("alter table cart add column if not exists quantity integer not null default 1 check (quantity > 0)")
+    op.execute("alter table order_items add column if not exists quantity integer not null default 1 check (quantity > 0)")
+
+    # Collapse the row-per-click cart into one row per product, the oldest row keeps the summed quantity
+    op.execute("""with grouped as (
+        select min(id) as keep_id, user_id, product_id, sum(quantity) as quantity from cart group by user_id, product_id having count(*) > 1
+    ), updated as (
+        update cart set quantity = grouped.quantity from grouped where cart.id = grouped.keep_id
+    )
+    delete from cart using grouped
+    where cart.user_id = grouped.user_id and cart.product_id = grouped.product_id and cart.id <> grouped.keep_id""")
+
+    with op.get_context().autocommit_block():
+        op.execute("create unique index concurrently if not exists cart_user_id_product_id_idx on cart (user_id, product_id)")
+        # The unique index starts with user_id and serves every lookup the old index did
+        op.execute("drop index concurrently if exists cart_user_id_idx")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute("create index concurrently if not exists cart_user_id_idx on cart (user_id)")
+        op.execute("drop index concurrently if exists cart_user_id_product_id_idx")
+
+    op.execute("alter table order_items drop column quantity")
+    op.execute("alter table cart drop column quantity")
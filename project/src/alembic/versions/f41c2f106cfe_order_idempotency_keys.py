@@ -0,0 +1,32 @@
+"""order idempotency keys
+
+Revision ID: f41c2f106cfe
+Revises: 3538684b8178
+Create Date: 2026-10-17 22:10:31.227845
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f41c2f106cfe'
+down_revision: Union[str, Sequence[str], None] = '3538684b8178'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade():
+    op.execute("alter table orders add column if not exists idempotency_key varchar(255)")
+
+    with op.get_context().autocommit_block():
+        op.execute("create unique index concurrently if not exists orders_user_id_idempotency_key_idx on orders (user_id, idempotency_key)")
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute("drop index concurrently if exists orders_user_id_idempotency_key_idx")
+
+    op.execute("alter table orders drop column idempotency_key")
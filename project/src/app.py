@@ -1,7 +1,46 @@
-from fastapi import FastAPI
-import uvicorn
-import __init__
-from main import app
+import os
+import sys
+
+
+def serve():
+    import uvicorn
+
+    workers = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+    if workers > 1:
+        # Every worker has its own bcrypt pool, together they should not use more processes than there are cores
+        os.environ.setdefault("HASHING_WORKERS", str(max((os.cpu_count() or 1) // workers, 1)))
+
+    # On SIGTERM workers stop accepting connections and finish the requests in flight for up to the timeout
+    uvicorn.run("main:app", host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", "80")), workers=workers,
+                timeout_graceful_shutdown=float(os.getenv("GRACEFUL_SHUTDOWN_TIMEOUT", "20")))
+
+
+def migrate():
+    from migrate import run_migrations
+
+    run_migrations()
+
+
+def backfill_sales():
+    import asyncio
+    import logging
+
+    from sales import BackfillRunningError, backfill
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    try:
+        asyncio.run(backfill())
+    except BackfillRunningError as e:
+        sys.exit(str(e))
+
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=80)
+    # Migrations run once per deploy with "migrate", workers only check that the schema is up to date
+    modes = {"serve": serve, "migrate": migrate, "backfill-sales": backfill_sales}
+    mode = sys.argv[1] if len(sys.argv) > 1 else "serve"
+
+    if mode not in modes:
+        sys.exit(f"usage: python app.py [{'|'.join(modes)}]")
+
+    modes[mode]()
@@ -1,22 +1,29 @@
-import datetime
+import os
 from typing import Annotated, Optional, TypeAlias
 from secrets import token_hex
 
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy import text
 from datetime import datetime, timezone
-from database import SessionDep
+from database import ReadSessionDep, SessionDep, async_session
 from models import User
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from cache import TTLCache
+import events
+import hashing
+import metrics
+import queries
+import tokens
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login_oauth")
 
+# Opening a session beyond this number closes the oldest sessions of the user
+MAX_SESSIONS_PER_USER = max(int(os.getenv("MAX_SESSIONS_PER_USER", "20")), 1)
+
+session_cache = TTLCache(max_size=int(os.getenv("SESSION_CACHE_SIZE", "10000")), ttl=float(os.getenv("SESSION_CACHE_TTL", "60")))
+
 
 async def query_user(username, session: SessionDep):
-    response = await session.execute(text("select * from users where email = :email"), {"email": username})
+    response = await session.execute(queries.FIND_USER_BY_EMAIL, {"email": username})
 
     user = response.first()
     if not user:
@@ -25,39 +32,122 @@ async def query_user(username, session: SessionDep):
     return User(*user)
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await hashing.verify(plain_password, hashed_password)
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await hashing.hash(password)
 
 
 def create_access_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.now(timezone.utc)
+    expire = int(datetime.now(timezone.utc).timestamp()) + tokens.ACCESS_TOKEN_TTL
 
     to_encode.update({"exp": expire})
     to_encode.update({"jti": token_hex(16)})
 
-    return get_password_hash(str(to_encode))
+    return tokens.encode(to_encode), to_encode
+
+
+async def open_session(user_id: int, session: SessionDep):
+    access_token, claims = create_access_token(data={"sub": user_id})
+
+    evicted = await session.execute(queries.OPEN_SESSION, {
+        "user_id": user_id, "token": claims["jti"], "expires_at": datetime.fromtimestamp(claims["exp"], timezone.utc),
+        "keep_sessions": MAX_SESSIONS_PER_USER - 1})
+
+    for token, expires_at in evicted:
+        metrics.EVICTED_SESSIONS.inc()
+        if tokens.is_legacy(token):
+            session_cache.invalidate(token)
+            await events.publish(session, "session_revoked", user_id=user_id, jti=None, exp=None)
+        else:
+            tokens.revoke(token, int(expires_at.timestamp()))
+            await events.publish(session, "session_revoked", user_id=user_id, jti=token, exp=int(expires_at.timestamp()))
+
+    return access_token
+
+
+async def create_user(user_fields: dict, session: SessionDep) -> tuple[int, str]:
+    """Inserts a user together with their first session and returns the user id and the access token."""
+    expire = int(datetime.now(timezone.utc).timestamp()) + tokens.ACCESS_TOKEN_TTL
+    jti = token_hex(16)
+
+    user_id = (await session.execute(queries.CREATE_USER_WITH_SESSION, {
+        **user_fields, "token": jti, "expires_at": datetime.fromtimestamp(expire, timezone.utc)})).scalar_one()
+
+    # The claims are the ones create_access_token would have made, only the user id is known after the insert
+    return user_id, tokens.encode({"sub": user_id, "exp": expire, "jti": jti})
+
+
+async def close_session(token: str, session: SessionDep):
+    session_cache.invalidate(token)
 
+    claims = tokens.decode(token)
+    if claims is None:
+        # Other workers cannot tell which cached entry is this token without it in the event, so they drop all of the user
+        closed = await session.execute(queries.CLOSE_LEGACY_SESSION, {"token": token})
+        for user_id, in closed:
+            await events.publish(session, "session_revoked", user_id=user_id, jti=None, exp=None)
+        return
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: SessionDep):
+    tokens.revoke(claims["jti"], claims["exp"])
+    await session.execute(queries.REVOKE_TOKEN, {"jti": claims["jti"], "expires_at": datetime.fromtimestamp(claims["exp"], timezone.utc)})
+    await session.execute(queries.CLOSE_SESSION, {"jti": claims["jti"]})
+    await events.publish(session, "session_revoked", user_id=claims["sub"], jti=claims["jti"], exp=claims["exp"])
+
+
+async def load_revoked_tokens():
+    async with async_session() as session:
+        revoked = await session.execute(queries.REVOKED_TOKENS)
+
+        for jti, expires_at in revoked:
+            tokens.revoke(jti, int(expires_at.timestamp()))
+
+
+def _apply_session_revoked(event: dict):
+    if event["jti"] is not None:
+        tokens.revoke(event["jti"], event["exp"])
+    else:
+        session_cache.invalidate_owner(event["user_id"])
+
+
+async def _resync_sessions(event: dict):
+    session_cache.clear()
+    await load_revoked_tokens()
+
+
+events.subscribe("session_revoked", _apply_session_revoked)
+events.subscribe("profile_updated", lambda event: session_cache.invalidate_owner(event["user_id"]))
+events.subscribe(events.RESYNC, _resync_sessions)
+
+
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], session: ReadSessionDep):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    user = await session.execute(text(
-        "select users.* from users right join sessions on users.id = sessions.user_id where sessions.token = :token"),
-                                 {"token": token})
+    claims = tokens.decode(token)
+    if claims is None and not tokens.is_legacy(token):
+        raise credentials_exception
+
+    user = session_cache.get(token)
+    if user is not None:
+        return user
+
+    if claims is not None:
+        user = await session.execute(queries.FIND_USER, {"id": claims["sub"]})
+    else:
+        user = await session.execute(queries.FIND_USER_BY_LEGACY_TOKEN, {"token": token})
 
     user = user.first()
     if user is None:
         raise credentials_exception
 
     user = User(*user)
+    session_cache.set(token, user, owner=user.id)
 
     return user
 
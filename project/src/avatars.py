@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import os
+import re
+import secrets
+from pathlib import Path
+
+from fastapi import Request
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+DATA_DIR = Path(os.getenv("DATA_DIR", "data"))
+AVATAR_DIR = DATA_DIR / "avatars"
+AVATAR_MAX_SIZE = int(os.getenv("AVATAR_MAX_SIZE", str(5 * 1024 * 1024)))
+AVATAR_THUMBNAIL_SIZE = int(os.getenv("AVATAR_THUMBNAIL_SIZE", "256"))
+# Checked from the image header, so that a small file cannot decode into a huge bitmap
+AVATAR_MAX_PIXELS = 40_000_000
+MAX_FIELD_SIZE = 4096
+
+AVATAR_FIELD = "avatar"
+AVATAR_URL = "/avatars/"
+# The schema default of users.profile_picture, written into AVATAR_DIR at startup
+DEFAULT_AVATAR = "default.jpg"
+# Files are named after a hash of the upload, so a name always refers to the same content
+AVATAR_NAME = re.compile(r"(?:[0-9a-f]{32}(?:-thumb)?\.(?:jpg|png|webp|gif)|default\.jpg)")
+FORMATS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif"}
+
+
+class AvatarError(Exception):
+    def __init__(self, message: str, status_code: int = 422):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _ProfileForm:
+    """Callbacks of the multipart parser: text fields are collected, the avatar file goes to disk as it arrives."""
+
+    def __init__(self, charset: str):
+        self.charset = charset
+        self.fields: dict[str, str] = {}
+        self.upload_path: Path | None = None
+        self.upload_size = 0
+        self.digest = hashlib.blake2b(digest_size=16)
+        self.pending: list[bytes] = []
+        self.file = None
+
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._name = ""
+        self._data = bytearray()
+
+    def on_part_begin(self):
+        self._disposition = b""
+        self._data = bytearray()
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name, self._header_value = b"", b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        self._name = options.get(b"name", b"").decode(self.charset, errors="replace")
+
+        if b"filename" not in options:
+            return
+        if self._name != AVATAR_FIELD or self.file is not None:
+            raise AvatarError(f"Only one file in the {AVATAR_FIELD} field is accepted")
+
+        AVATAR_DIR.mkdir(parents=True, exist_ok=True)
+        self.upload_path = AVATAR_DIR / f".upload-{secrets.token_hex(8)}"
+        self.file = open(self.upload_path, "wb")
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self.file is not None and self._name == AVATAR_FIELD:
+            self.upload_size += end - start
+            if self.upload_size > AVATAR_MAX_SIZE:
+                raise AvatarError(f"Avatar is larger than {AVATAR_MAX_SIZE} bytes", status_code=413)
+
+            chunk = data[start:end]
+            self.digest.update(chunk)
+            self.pending.append(chunk)
+            return
+
+        self._data += data[start:end]
+        if len(self._data) > MAX_FIELD_SIZE:
+            raise AvatarError(f"Field {self._name} is too long")
+
+    def on_part_end(self):
+        if self.file is None or self._name != AVATAR_FIELD:
+            self.fields[self._name] = self._data.decode(self.charset, errors="replace")
+
+
+def _store_avatar(upload_path: Path, digest: str) -> str:
+    """Checks that the upload is an image, writes its thumbnail and moves it under its final name."""
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(upload_path) as image:
+            extension = FORMATS.get(image.format)
+            if extension is None:
+                raise AvatarError(f"Avatar must be one of {', '.join(FORMATS)}")
+            if image.width * image.height > AVATAR_MAX_PIXELS:
+                raise AvatarError("Avatar has too many pixels")
+
+            # JPEG can be decoded at a fraction of its size, which is much faster for photos
+            image.draft("RGB", (AVATAR_THUMBNAIL_SIZE, AVATAR_THUMBNAIL_SIZE))
+            thumbnail = ImageOps.exif_transpose(image)
+            thumbnail.thumbnail((AVATAR_THUMBNAIL_SIZE, AVATAR_THUMBNAIL_SIZE))
+
+            if thumbnail.mode in ("RGBA", "LA", "P"):
+                thumbnail = thumbnail.convert("RGBA")
+                background = Image.new("RGB", thumbnail.size, "white")
+                background.paste(thumbnail, mask=thumbnail.getchannel("A"))
+                thumbnail = background
+            thumbnail.convert("RGB").save(AVATAR_DIR / f"{digest}-thumb.jpg", "JPEG", quality=85, optimize=True)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        raise AvatarError("Avatar is not a valid image")
+
+    name = f"{digest}.{extension}"
+    os.replace(upload_path, AVATAR_DIR / name)
+    return name
+
+
+async def receive_profile_form(request: Request) -> tuple[dict[str, str], str | None]:
+    """Reads a multipart profile update and returns its text fields and the URL of the uploaded avatar, if any."""
+    content_length = request.headers.get("content-length")
+    if content_length is not None and content_length.isdigit() and int(content_length) > AVATAR_MAX_SIZE + 64 * 1024:
+        raise AvatarError(f"Avatar is larger than {AVATAR_MAX_SIZE} bytes", status_code=413)
+
+    _, params = parse_options_header(request.headers.get("content-type", ""))
+    if b"boundary" not in params:
+        raise AvatarError("Missing multipart boundary")
+
+    form = _ProfileForm(params.get(b"charset", b"utf-8").decode("latin-1"))
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": form.on_part_begin,
+        "on_part_data": form.on_part_data,
+        "on_part_end": form.on_part_end,
+        "on_header_field": form.on_header_field,
+        "on_header_value": form.on_header_value,
+        "on_header_end": form.on_header_end,
+        "on_headers_finished": form.on_headers_finished,
+    })
+
+    try:
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+
+                # Disk writes happen in a thread, the parser callbacks only collect the chunks
+                if form.pending:
+                    await asyncio.to_thread(form.file.writelines, form.pending)
+                    form.pending = []
+
+            parser.finalize()
+        except FormParserError:
+            raise AvatarError("Malformed multipart body")
+        finally:
+            if form.file is not None:
+                form.file.close()
+
+        if form.file is None:
+            return form.fields, None
+        if form.upload_size == 0:
+            raise AvatarError("Avatar is empty")
+
+        name = await asyncio.to_thread(_store_avatar, form.upload_path, form.digest.hexdigest())
+        return form.fields, AVATAR_URL + name
+    finally:
+        # After a successful upload the file is already moved to its final name
+        if form.upload_path is not None:
+            form.upload_path.unlink(missing_ok=True)
+
+
+def ensure_default_avatar():
+    """Draws the avatar of users who never uploaded one, unless the data dir already has it."""
+    path = AVATAR_DIR / DEFAULT_AVATAR
+    if path.is_file():
+        return
+
+    from PIL import Image, ImageDraw
+
+    size = AVATAR_THUMBNAIL_SIZE
+    image = Image.new("RGB", (size, size), "#dfe3e8")
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((size * 0.32, size * 0.18, size * 0.68, size * 0.54), fill="#a7b0bc")
+    draw.ellipse((size * 0.14, size * 0.6, size * 0.86, size * 1.3), fill="#a7b0bc")
+
+    # Workers start at the same time, each writes its own file and the rename is atomic
+    AVATAR_DIR.mkdir(parents=True, exist_ok=True)
+    temporary = AVATAR_DIR / f".default-{secrets.token_hex(8)}"
+    image.save(temporary, "JPEG", quality=85)
+    os.replace(temporary, path)
+
+
+def avatar_path(name: str) -> Path | None:
+    return AVATAR_DIR / name if AVATAR_NAME.fullmatch(name) else None
+
+
+def is_avatar_url(url: str) -> bool:
+    return url.startswith(AVATAR_URL) and avatar_path(url[len(AVATAR_URL):]) is not None
+
+
+def thumbnail_url(url: str) -> str:
+    """URL of the thumbnail of an uploaded avatar; other avatars are returned as they are."""
+    name = url[len(AVATAR_URL):] if url.startswith(AVATAR_URL) else ""
+    if not AVATAR_NAME.fullmatch(name) or "-thumb" in name or name == DEFAULT_AVATAR:
+        return url
+
+    return AVATAR_URL + name.rsplit(".", 1)[0] + "-thumb.jpg"
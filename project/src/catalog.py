@@ -0,0 +1,235 @@
+import asyncio
+import base64
+import hashlib
+import json
+import math
+from decimal import Decimal
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import async_session
+from serialization import dump_json
+import events
+
+PRODUCT_COLUMNS = "id, name, description, price"
+
+# products.price is decimal(10, 2)
+MAX_PRICE = 10 ** 8
+
+
+def invalid_product_fields(name: str | None, price: float | None) -> list[str]:
+    """Returns the fields of a product that do not pass validation, None means the field is not set."""
+    fields = []
+
+    if price is not None and (math.isinf(price) or math.isnan(price) or abs(price) >= MAX_PRICE):
+        fields.append("price")
+    if name is not None and (name == "" or len(name) > 255):
+        fields.append("name")
+
+    return fields
+
+
+class CatalogSnapshot:
+    """Serialized GET /products response kept in memory.
+
+    The product handlers patch the snapshot after their commit, so reads never go to the database
+    once the snapshot is built. It is built from the primary: a lagging replica would leave it stale until the next product change.
+    """
+
+    def __init__(self):
+        self.body: bytes | None = None
+        self.etag: str | None = None
+        self._products: dict[int, dict] | None = None
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    async def get(self) -> tuple[bytes, str]:
+        if self.body is not None:
+            return self.body, self.etag
+
+        async with self._lock:
+            if self.body is not None:
+                return self.body, self.etag
+
+            generation = self._generation
+            async with async_session() as session:
+                rows = (await session.execute(text(f"select {PRODUCT_COLUMNS} from products order by id"))).all()
+            products = {row.id: row._asdict() for row in rows}
+            body = dump_json(list(products.values()))
+            etag = self._etag(body)
+
+            # A product changed while the query was running and the rows may miss it, so serve them once without keeping them
+            if generation == self._generation:
+                self._products = products
+                self.body = body
+                self.etag = etag
+
+            return body, etag
+
+    def upsert(self, product: dict):
+        if self._products is None:
+            self._generation += 1
+            return
+
+        out_of_order = product["id"] not in self._products and self._products and product["id"] < next(reversed(self._products))
+
+        self._products[product["id"]] = product
+        if out_of_order:
+            self._products = dict(sorted(self._products.items()))
+
+        self._serialize()
+
+    def remove(self, product_id: int):
+        if self._products is None:
+            self._generation += 1
+            return
+
+        if self._products.pop(product_id, None) is not None:
+            self._serialize()
+
+    def invalidate(self):
+        self._generation += 1
+        self._products = None
+        self.body = None
+        self.etag = None
+
+    def _serialize(self):
+        self.body = dump_json(list(self._products.values()))
+        self.etag = self._etag(self.body)
+
+    @staticmethod
+    def _etag(body: bytes) -> str:
+        return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+# sort option -> (keyset columns, direction)
+PRODUCT_SORTS = {
+    "id": (("id",), "asc"),
+    "-id": (("id",), "desc"),
+    "price": (("price", "id"), "asc"),
+    "-price": (("price", "id"), "desc"),
+}
+
+
+def encode_cursor(values: list) -> str:
+    return base64.urlsafe_b64encode(dump_json(values)).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+
+    return values
+
+
+async def list_products_page(session: AsyncSession, limit: int, cursor: str | None = None, min_price: float | None = None,
+                             max_price: float | None = None, sort: str = "id"):
+    """Returns one page of products and the cursor of the next page, every page is a range scan of the sort index."""
+    columns, direction = PRODUCT_SORTS[sort]
+    conditions = []
+    params = {"limit": limit}
+
+    if min_price is not None:
+        conditions.append("price >= :min_price")
+        params["min_price"] = min_price
+    if max_price is not None:
+        conditions.append("price <= :max_price")
+        params["max_price"] = max_price
+
+    if cursor is not None:
+        values = decode_cursor(cursor, len(columns))
+        comparison = ">" if direction == "asc" else "<"
+        keys = ", ".join(f":after_{column}" for column in columns)
+
+        conditions.append(f"({', '.join(columns)}) {comparison} ({keys})")
+        # Prices are rounded to the cents of the column, asyncpg can not send a decimal with a very large exponent
+        try:
+            for column, value in zip(columns, values):
+                params[f"after_{column}"] = Decimal(str(value)).quantize(Decimal("0.01")) if column == "price" else int(value)
+        except (ArithmeticError, TypeError):
+            raise ValueError("Invalid cursor")
+        if not 0 < params["after_id"] < 2 ** 31:
+            raise ValueError("Invalid cursor")
+
+    where = f"where {' and '.join(conditions)} " if conditions else ""
+    order = ", ".join(f"{column} {direction}" for column in columns)
+
+    rows = (await session.execute(text(f"select {PRODUCT_COLUMNS} from products {where}order by {order} limit :limit"), params)).all()
+
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = encode_cursor([getattr(rows[-1], column) for column in columns])
+
+    return rows, next_cursor
+
+
+# Every match is ranked before a page is cut, a capped set of candidates would drop the best matches of a common word.
+# The columns are read in the same scan, so the index scan feeds the top-N sort without joining products again
+SEARCH_TEXT_RANK = "1 + ts_rank_cd(search_vector, websearch_to_tsquery('russian', :query))"
+SEARCH_TEXT_MATCHES = f"select {PRODUCT_COLUMNS}, {SEARCH_TEXT_RANK} as rank from products where search_vector @@ websearch_to_tsquery('russian', :query)"
+
+SEARCH_PRODUCTS = (
+    f"select {PRODUCT_COLUMNS} from products where search_vector @@ websearch_to_tsquery('russian', :query) "
+    f"order by {SEARCH_TEXT_RANK} desc, id limit :limit offset :offset"
+)
+
+# Full text matches rank above 1, typo tolerant matches on the name rank by their similarity below it
+SEARCH_PRODUCTS_FUZZY = (
+    f"with matches as ({SEARCH_TEXT_MATCHES} union all "
+    f"select {PRODUCT_COLUMNS}, word_similarity(cast(:query as text), name) as rank from products where cast(:query as text) <% name) "
+    f"select {PRODUCT_COLUMNS} from matches group by {PRODUCT_COLUMNS} order by max(rank) desc, id limit :limit offset :offset"
+)
+
+# Whether pg_trgm is installed, the migration skips it where the server does not ship the extension
+_fuzzy_search: bool | None = None
+
+
+async def search_products(session: AsyncSession, query: str, limit: int, cursor: str | None = None):
+    """Returns one page of products ranked by how well they match query and the cursor of the next page."""
+    global _fuzzy_search
+
+    offset = 0
+    if cursor is not None:
+        offset = decode_cursor(cursor, 1)[0]
+        # The cursors this returns hold an integer offset; bool is an int subclass and would pass isinstance
+        if type(offset) is not int or not 0 <= offset < 2 ** 31:
+            raise ValueError("Invalid cursor")
+
+    if _fuzzy_search is None:
+        _fuzzy_search = (await session.execute(text("select exists (select 1 from pg_extension where extname = 'pg_trgm')"))).scalar()
+
+    params = {"query": query, "limit": limit, "offset": offset}
+    rows = (await session.execute(text(SEARCH_PRODUCTS_FUZZY if _fuzzy_search else SEARCH_PRODUCTS), params)).all()
+
+    next_cursor = encode_cursor([offset + limit]) if len(rows) == limit else None
+    return rows, next_cursor
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+
+    return any(candidate.strip() in (etag, "*") for candidate in if_none_match.split(","))
+
+
+catalog = CatalogSnapshot()
+
+
+async def publish_product(session: AsyncSession, product: dict, writer: int):
+    """Sends a created or updated product to the snapshots of the other workers, a product too large for one event makes them reload."""
+    try:
+        await events.publish(session, "product_upserted", writer=writer, product=product)
+    except ValueError:
+        await events.publish(session, "catalog_invalidated", writer=writer)
+
+
+events.subscribe("product_upserted", lambda event: catalog.upsert(event["product"]))
+events.subscribe("product_removed", lambda event: catalog.remove(event["id"]))
+events.subscribe("catalog_invalidated", lambda event: catalog.invalidate())
+events.subscribe(events.RESYNC, lambda event: catalog.invalidate())
@@ -0,0 +1,178 @@
+import asyncio
+import inspect
+import logging
+import os
+import secrets
+
+import asyncpg
+import orjson
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import engine, mark_written, write_listeners
+from serialization import dump_json
+import metrics
+
+CHANNEL = "simple_to_buy_events"
+EVENTS_RECONNECT_INTERVAL = float(os.getenv("EVENTS_RECONNECT_INTERVAL", "1"))
+# An idle listening connection is checked this often, a dropped one is not always reported by the socket
+EVENTS_PING_INTERVAL = float(os.getenv("EVENTS_PING_INTERVAL", "30"))
+# Postgres rejects notifications over 8000 bytes
+MAX_PAYLOAD_SIZE = 7900
+
+# Sent to the handlers of this worker after a reconnect, when events of other workers may have been missed
+RESYNC = "resync"
+
+# Events of this worker are already applied when they are published, so the listener skips them
+WORKER_ID = secrets.token_hex(8)
+
+# Users who wrote through this worker are announced to the others in events of this kind, up to this many per event
+USERS_WRITTEN = "users_written"
+MAX_ANNOUNCED_USERS = 500
+
+logger = logging.getLogger(__name__)
+
+_handlers: dict[str, list] = {}
+_connected = False
+# Queue of the listening connection and the users waiting to be announced on it
+_queue: asyncio.Queue | None = None
+_unannounced: set[int] = set()
+_ANNOUNCE = object()
+
+
+def subscribe(kind: str, handler):
+    """Calls handler with the event dict for every event of kind published by another worker."""
+    _handlers.setdefault(kind, []).append(handler)
+
+
+def encode(kind: str, **data) -> str | None:
+    payload = dump_json({"kind": kind, "origin": WORKER_ID, **data}).decode()
+    return payload if len(payload.encode()) <= MAX_PAYLOAD_SIZE else None
+
+
+async def publish(session: AsyncSession, kind: str, writer: int | None = None, **data):
+    """Queues an event in the transaction of session; Postgres delivers it on commit and drops it on rollback.
+
+    The other workers serve the writer from the primary before they apply the event, so a handler that drops
+    cached state of the writer never fills it again from a lagging replica.
+    """
+    if writer is not None:
+        data["writer"] = writer
+
+    payload = encode(kind, **data)
+    if payload is None:
+        raise ValueError(f"Event {kind} is larger than {MAX_PAYLOAD_SIZE} bytes")
+
+    await session.execute(text("select pg_notify(:channel, :payload)"), {"channel": CHANNEL, "payload": payload})
+
+
+def _announce_write(user_id: int):
+    # Without a listening connection the other workers resynchronize once it is back, nothing to announce until then
+    if _queue is None:
+        return
+
+    if not _unannounced:
+        _queue.put_nowait(_ANNOUNCE)
+    _unannounced.add(user_id)
+
+
+async def _send_announcements(connection):
+    """Announces the users who wrote since the last call, outside of any transaction and without holding up their requests."""
+    user_ids = list(_unannounced)
+    _unannounced.clear()
+
+    for start in range(0, len(user_ids), MAX_ANNOUNCED_USERS):
+        await connection.execute("select pg_notify($1, $2)", CHANNEL, encode(USERS_WRITTEN, user_ids=user_ids[start:start + MAX_ANNOUNCED_USERS]))
+
+
+def _apply_users_written(event: dict):
+    for user_id in event["user_ids"]:
+        mark_written(user_id, announce=False)
+
+
+async def _dispatch(event: dict):
+    kind = event.get("kind")
+    metrics.EVENTS_RECEIVED.inc((kind,))
+
+    if event.get("writer") is not None:
+        mark_written(event["writer"], announce=False)
+
+    for handler in _handlers.get(kind, ()):
+        try:
+            result = handler(event)
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logger.exception("Handler of event %s failed", kind)
+
+
+def _listen_dsn() -> str:
+    return engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+async def run():
+    """Applies the events of other workers until cancelled, reconnecting when the connection drops."""
+    global _connected, _queue
+
+    connected_before = False
+
+    while True:
+        try:
+            connection = await asyncpg.connect(_listen_dsn())
+        except Exception as e:
+            logger.warning("Could not connect to listen for events: %r", e)
+            await asyncio.sleep(EVENTS_RECONNECT_INTERVAL)
+            continue
+
+        # None in the queue means the connection was closed
+        queue: asyncio.Queue = asyncio.Queue()
+        connection.add_termination_listener(lambda _: queue.put_nowait(None))
+
+        try:
+            await connection.add_listener(CHANNEL, lambda _connection, _pid, _channel, payload: queue.put_nowait(payload))
+            _connected = True
+            _queue = queue
+
+            if connected_before:
+                logger.info("Listening for events again, resynchronizing cached state")
+                await _dispatch({"kind": RESYNC})
+            connected_before = True
+
+            while True:
+                try:
+                    payload = await asyncio.wait_for(queue.get(), EVENTS_PING_INTERVAL)
+                except asyncio.TimeoutError:
+                    await asyncio.wait_for(connection.execute("select 1"), EVENTS_PING_INTERVAL)
+                    continue
+
+                if payload is None:
+                    raise ConnectionError("the connection was closed")
+                if payload is _ANNOUNCE:
+                    await _send_announcements(connection)
+                    continue
+
+                try:
+                    event = orjson.loads(payload)
+                except orjson.JSONDecodeError:
+                    logger.warning("Skipping a malformed event: %r", payload[:200])
+                    continue
+
+                if event.get("origin") != WORKER_ID:
+                    await _dispatch(event)
+        except Exception as e:
+            logger.warning("Lost the event listener connection: %r", e)
+        finally:
+            _connected = False
+            _queue = None
+            _unannounced.clear()
+            connection.terminate()
+
+        await asyncio.sleep(EVENTS_RECONNECT_INTERVAL)
+
+
+write_listeners.append(_announce_write)
+subscribe(USERS_WRITTEN, _apply_users_written)
+
+
+def stats():
+    return {"listener_connected": int(_connected)}
@@ -0,0 +1,60 @@
+import csv
+import io
+from typing import AsyncIterator
+
+from sqlalchemy import text
+
+from catalog import PRODUCT_COLUMNS
+from database import async_session
+from serialization import dump_json
+
+# Rows fetched from the server-side cursor at once and bytes sent to the client at once
+FETCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+EXPORT_PRODUCTS = f"select {PRODUCT_COLUMNS} from products order by id"
+
+# One row per order item, so both formats stay flat
+EXPORT_ORDERS = (
+    "select orders.id as order_id, orders.user_id, orders.order_price, order_items.product_id, order_items.name, "
+    "order_items.unit_price, order_items.quantity from orders inner join order_items on order_items.order_id = orders.id "
+    "order by orders.id, order_items.id"
+)
+
+
+def _csv_line(values) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue().encode("utf-8")
+
+
+async def stream_export(statement: str, export_format: str) -> AsyncIterator[bytes]:
+    """Yields the rows of statement as NDJSON or CSV in chunks of about CHUNK_SIZE bytes.
+
+    The session is opened here and not taken from a dependency, because the response is sent after
+    request dependencies are closed. Each chunk is only produced when the client has taken the previous one,
+    so memory does not grow with the table.
+    """
+    async with async_session() as session:
+        result = await session.stream(text(statement).execution_options(yield_per=FETCH_SIZE))
+        chunk = bytearray()
+
+        if export_format == "csv":
+            chunk += _csv_line(result.keys())
+
+        async for rows in result.partitions(FETCH_SIZE):
+            for row in rows:
+                if export_format == "csv":
+                    chunk += _csv_line(row)
+                else:
+                    chunk += dump_json(row)
+                    chunk += b"\n"
+
+                if len(chunk) >= CHUNK_SIZE:
+                    yield bytes(chunk)
+                    chunk.clear()
+
+        if chunk:
+            yield bytes(chunk)
@@ -0,0 +1,81 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+import metrics
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+HASHING_WORKERS = int(os.getenv("HASHING_WORKERS", str(os.cpu_count() or 1)))
+HASHING_QUEUE_LIMIT = int(os.getenv("HASHING_QUEUE_LIMIT", "64"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+_executor: ProcessPoolExecutor | None = None
+_in_flight = 0
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _ready() -> bool:
+    return True
+
+
+def start():
+    global _executor
+
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=HASHING_WORKERS, mp_context=multiprocessing.get_context("fork"))
+
+        # The pool only forks on its first task, and by then the process may run threads (the thread pool of sync
+        # handlers, the resolver of the event loop) whose locks a forked child would inherit held. Warming it up here,
+        # before anything else at startup, forks a single-threaded process and spares the first login the fork.
+        for ready in [_executor.submit(_ready) for _ in range(HASHING_WORKERS)]:
+            ready.result()
+
+    return _executor
+
+
+def shutdown():
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def stats():
+    return {"workers": HASHING_WORKERS, "in_flight": _in_flight, "queue_limit": HASHING_QUEUE_LIMIT}
+
+
+async def _submit(operation: str, function, *args):
+    global _in_flight
+
+    if _in_flight >= HASHING_QUEUE_LIMIT:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Server is busy, try again later", headers={"Retry-After": "1"})
+
+    _in_flight += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(start(), function, *args)
+    finally:
+        _in_flight -= 1
+        metrics.HASHING_SECONDS.observe(time.perf_counter() - started, (operation,))
+
+
+async def hash(password: str) -> str:
+    return await _submit("hash", _hash, password)
+
+
+async def verify(plain_password: str, hashed_password: str) -> bool:
+    return await _submit("verify", _verify, plain_password, hashed_password)
@@ -1,14 +1,52 @@
-import math
-from fastapi import Depends, FastAPI, HTTPException
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta, timezone
+import orjson
+from typing import Literal
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from models import *
-from database import SessionDep
-from authorization import oauth2_scheme, query_user, verify_password, get_password_hash, create_access_token, UserDep
-from fastapi.responses import JSONResponse
-import email_validator
-
-app = FastAPI()
+from database import ReadSessionDep, SessionDep, engine, env_flag, mark_written, pool_stats
+from authorization import session_cache, oauth2_scheme, query_user, verify_password, get_password_hash, open_session, close_session, create_user, load_revoked_tokens, UserDep
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import ValidationError
+import avatars
+from catalog import catalog, decode_cursor, encode_cursor, etag_matches, invalid_product_fields, list_products_page, publish_product, search_products
+from exports import EXPORT_ORDERS, EXPORT_PRODUCTS, MEDIA_TYPES as EXPORT_TYPES, stream_export
+import events
+import hashing
+import metrics
+from migrate import check_schema
+import queries
+import rate_limit
+from serialization import ORJSONResponse
+import session_purge
+from product_import import SUPPORTED_TYPES as IMPORT_TYPES, ImportFormatError, import_products
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # First, while the process has no other threads to fork with
+    hashing.start()
+    await check_schema(engine)
+    avatars.ensure_default_avatar()
+    # Listening starts before the revoked tokens are loaded, so no revocation falls in between
+    listener = asyncio.create_task(events.run())
+    await load_revoked_tokens()
+    loop_lag = asyncio.create_task(metrics.sample_loop_lag())
+    purge = asyncio.create_task(session_purge.run_purge())
+    yield
+    purge.cancel()
+    loop_lag.cancel()
+    listener.cancel()
+    hashing.shutdown()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(metrics.MetricsMiddleware)
 
 forbidden = JSONResponse(status_code=403, content={"message": "Forbidden for you"})
 
@@ -22,9 +60,16 @@ def generate_validation_error_for_fields(*fields: str):
     return JSONResponse(status_code=422, content=details)
 
 
+# The deliverability check resolves the domain of the email, a blocking DNS lookup
+EMAIL_CHECK_DELIVERABILITY = env_flag("EMAIL_CHECK_DELIVERABILITY", True)
+
+
 def is_email_valid(email: str | None):
+    # Only signup and profile updates need it, so it is not imported at startup
+    import email_validator
+
     try:
-        email_validator.validate_email(email)
+        email_validator.validate_email(email, check_deliverability=EMAIL_CHECK_DELIVERABILITY)
     except Exception as a:
         return False
 
@@ -33,19 +78,45 @@ def is_email_valid(email: str | None):
 
 @app.get("/api/health")
 def health_check():
-    return {"status": "healthy"}
+    return {"status": "healthy", "session_cache": session_cache.stats(), "pool": pool_stats()}
+
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    gauges = {}
+
+    for pool, stats in pool_stats().items():
+        for key in ("size", "checked_out", "overflow", "waiting", "timeouts", "connect_errors"):
+            gauges.setdefault(f"db_pool_{key}", []).append(({"pool": pool}, stats[key]))
+
+    for key, value in session_cache.stats().items():
+        gauges[f"session_cache_{key}"] = [({}, value)]
+
+    for key, value in hashing.stats().items():
+        gauges[f"password_hashing_{key}"] = [({}, value)]
+
+    for key, value in session_purge.stats().items():
+        gauges[f"expired_rows_purge_{key}"] = [({}, value)]
+
+    for key, value in events.stats().items():
+        gauges[f"events_{key}"] = [({}, value)]
+
+    for limit, stats in rate_limit.stats().items():
+        for key, value in stats.items():
+            gauges.setdefault(f"rate_limit_{key}", []).append(({"limit": limit}, value))
+
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
 
 
 @app.post("/login_oauth")
-async def login_oauth(new_user: Annotated[OAuth2PasswordRequestForm, Depends()], session: SessionDep):
+async def login_oauth(request: Request, new_user: Annotated[OAuth2PasswordRequestForm, Depends()], session: SessionDep):
+    await rate_limit.check(request, new_user.username)
     user = await query_user(new_user.username, session)
 
-    if not user or not verify_password(new_user.password, user.password_hash):
+    if not user or not await verify_password(new_user.password, user.password_hash):
         raise HTTPException(status_code=401, detail="Login failed")
 
-    access_token = create_access_token(data={"sub": user.id})
-
-    await session.execute(text("insert into sessions (user_id, token) values (:user_id, :token) returning token"), {"user_id": user.id, "token": access_token})
+    access_token = await open_session(user.id, session)
     await session.commit()
     return {"message": "Logged in successfully", "access_token": access_token}
 
@@ -54,15 +125,14 @@ async def login_oauth(new_user: Annotated[OAuth2PasswordRequestForm, Depends()],
 
 
 @app.post("/login")
-async def login(new_user: UserAuthorization, session: SessionDep):
+async def login(request: Request, new_user: UserAuthorization, session: SessionDep):
+    await rate_limit.check(request, new_user.email)
     user = await query_user(new_user.email, session)
 
-    if not user or not verify_password(new_user.password, user.password_hash):
+    if not user or not await verify_password(new_user.password, user.password_hash):
         return JSONResponse(status_code=401, content={"password": "Login failed"})
 
-    access_token = create_access_token(data={"sub": user.id})
-
-    await session.execute(text("insert into sessions (user_id, token) values (:user_id, :token) returning token"), {"user_id": user.id, "token": access_token})
+    access_token = await open_session(user.id, session)
     await session.commit()
 
     return {"message": "Logged in successfully", "user_token": access_token}
@@ -70,13 +140,14 @@ async def login(new_user: UserAuthorization, session: SessionDep):
 
 @app.post("/logout")
 async def logout(token: Annotated[str, Depends(oauth2_scheme)], session: SessionDep):
-    await session.execute(text("delete from sessions where token = :token"), {"token": token})
+    await close_session(token, session)
     await session.commit()
     return {"message": "Logged out successfully"}
 
 
 @app.post("/signup")
-async def register(new_user: UserSignup, session: SessionDep):
+async def register(request: Request, new_user: UserSignup, session: SessionDep):
+    await rate_limit.check(request, new_user.email)
     try:
         if not is_email_valid(new_user.email):
             return generate_validation_error_for_fields("email")
@@ -88,7 +159,7 @@ async def register(new_user: UserSignup, session: SessionDep):
         if len(fio) < 2 or len(fio) > 3:
             return generate_validation_error_for_fields("fio")
 
-        hashed_password = get_password_hash(new_user.password)
+        hashed_password = await get_password_hash(new_user.password)
 
         name = fio[0]
         surname = fio[1]
@@ -98,17 +169,14 @@ async def register(new_user: UserSignup, session: SessionDep):
         else:
             middle_name = None
 
-        insert_user = text("insert into users (name,surname,middle_name, email, password_hash) values (:name, :surname,:middle_name, :email, :password) returning id")
-        id = await session.execute(insert_user, {"name": name, "surname": surname, "middle_name": middle_name, "email": new_user.email, "password": hashed_password})
-        await session.commit()
-
-        user_id = id.scalar_one()
-
-        access_token = create_access_token(data={"sub": user_id})
-
-        await session.execute(text("insert into sessions (user_id, token) values (:user_id, :token) returning token"), {"user_id": user_id, "token": access_token})
+        user_id, access_token = await create_user({"name": name, "surname": surname, "middle_name": middle_name, "email": new_user.email,
+                                                   "password_hash": hashed_password}, session)
         await session.commit()
+        mark_written(user_id)
 
+    except HTTPException:
+        await session.rollback()
+        raise
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -117,36 +185,109 @@ async def register(new_user: UserSignup, session: SessionDep):
 
 
 @app.get("/profile")
-def get_profile(user: UserDep, session: SessionDep):
-    return {"user": {"id": user.id, "fio": user.name + " " + user.surname + (" " + user.middle_name if user.middle_name is not None else ""), "avatar": user.avatar, "email": user.email}}
+def get_profile(user: UserDep, session: ReadSessionDep):
+    return {"user": {"id": user.id, "fio": user.name + " " + user.surname + (" " + user.middle_name if user.middle_name is not None else ""), "avatar": user.avatar,
+                     "avatar_thumbnail": avatars.thumbnail_url(user.avatar), "email": user.email}}
+
+
+# Avatar names are content hashes, so a file never changes and the hash is its ETag
+AVATAR_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+@app.get("/avatars/{name}")
+async def get_avatar(name: str, request: Request):
+    path = avatars.avatar_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Avatar not found")
+
+    headers = {"ETag": '"' + name.rsplit(".", 1)[0] + '"', "Cache-Control": AVATAR_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Avatar not found")
+
+    # Sent with sendfile by servers that support the pathsend extension, otherwise streamed in chunks from a thread
+    return FileResponse(path, headers=headers)
 
 
 @app.get("/products")
-async def get_products(session: SessionDep):
-    products = (await session.execute(text("select * from products"))).all()
-    return [product._asdict() for product in products]
+async def get_products(request: Request, session: ReadSessionDep, limit: Annotated[Optional[int], Query(ge=1, le=500)] = None,
+                       cursor: Optional[str] = None, min_price: Optional[float] = None, max_price: Optional[float] = None,
+                       sort: Literal["id", "-id", "price", "-price"] = "id"):
+    if limit is not None or cursor is not None or min_price is not None or max_price is not None or sort != "id":
+        try:
+            items, next_cursor = await list_products_page(session, limit or 50, cursor, min_price, max_price, sort)
+        except ValueError:
+            return generate_validation_error_for_fields("cursor")
+
+        return ORJSONResponse({"items": items, "next_cursor": next_cursor})
+
+    body, etag = await catalog.get()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.get("/products/search")
+async def search_products_by_text(session: ReadSessionDep, q: Annotated[str, Query(min_length=1, max_length=200)],
+                                  limit: Annotated[int, Query(ge=1, le=100)] = 20, cursor: Optional[str] = None):
+    try:
+        items, next_cursor = await search_products(session, q, limit, cursor)
+    except ValueError:
+        return generate_validation_error_for_fields("cursor")
+
+    return ORJSONResponse({"items": items, "next_cursor": next_cursor})
 
 
 # Module 2
 
 
 @app.post("/cart/{product_id}")
-async def add_to_cart(product_id: int, user: UserDep, session: SessionDep):
+async def add_to_cart(product_id: int, user: UserDep, session: SessionDep, quantity: Annotated[int, Query(ge=1, le=MAX_CART_QUANTITY)] = 1):
     try:
-        await session.execute(text("insert into cart (user_id, product_id) values (:user_id, :product_id)"), {"user_id": user.id, "product_id": product_id})
+        added = await session.execute(queries.ADD_TO_CART, {"user_id": user.id, "product_id": product_id, "quantity": quantity,
+                                                            "max_quantity": MAX_CART_QUANTITY})
         await session.commit()
+        mark_written(user.id)
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+    if added.rowcount == 0:
+        return JSONResponse(status_code=400, content={"message": f"Cart can hold at most {MAX_CART_QUANTITY} of a product"})
+
     return {"message": "Added to cart successfully"}
 
 
+@app.put("/cart")
+async def set_cart_items(items: list[CartItem], user: UserDep, session: SessionDep):
+    if not items:
+        return JSONResponse(status_code=400, content={"message": "No input provided"})
+
+    # The last entry wins when a product is listed twice
+    quantities = {item.product_id: item.quantity for item in items}
+
+    try:
+        await session.execute(queries.SET_CART_ITEMS, {"user_id": user.id, "product_ids": list(quantities), "quantities": list(quantities.values())})
+        await session.commit()
+        mark_written(user.id)
+    except Exception as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {"message": "Cart updated successfully"}
+
+
 @app.delete("/cart/{cart_id}")
 async def remove_from_cart(cart_id: int, user: UserDep, session: SessionDep):
     try:
-        rows_affected = await session.execute(text("delete from cart where user_id = :user_id and id = :id"), {"user_id": user.id, "id": cart_id})
+        rows_affected = await session.execute(queries.REMOVE_FROM_CART, {"user_id": user.id, "id": cart_id})
         await session.commit()
+        mark_written(user.id)
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -158,46 +299,79 @@ async def remove_from_cart(cart_id: int, user: UserDep, session: SessionDep):
 
 
 @app.get("/cart")
-async def get_cart(user: UserDep, session: SessionDep):
+async def get_cart(user: UserDep, session: ReadSessionDep):
     try:
-        cart_items = (await session.execute(text(
-            "select cart.id, cart.product_id, products.name, products.description, products.price from cart "
-            "inner join products on cart.product_id = products.id where cart.user_id = :user_id"), {"user_id": user.id})).all()
+        cart_items = (await session.execute(queries.CART_ITEMS, {"user_id": user.id})).all()
 
-        return [item._asdict() for item in cart_items]
+        return ORJSONResponse(cart_items)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/order")
-async def place_order(user: UserDep, session: SessionDep):
-    try:
-        cart_items_quantity = (await session.execute(text("select count(product_id) as quantity from cart where user_id = :user_id"), {"user_id": user.id})).scalar()
-
-        if cart_items_quantity <= 0:
-            return JSONResponse(status_code=400, content={"message": "Cart is empty"})
-
-        order_id = await session.execute(text(
-            "insert into orders (user_id, order_price) values "
-            "(:user_id, (select sum(price) from cart inner join products on cart.product_id = products.id where cart.user_id = :user_id)) returning id"),
-            {"user_id": user.id})
-        order_id = order_id.scalar_one()
-        await session.commit()
-
-        await session.execute(text("insert into order_items (order_id, product_id) select :order_id, product_id from cart where user_id = :user_id"),
-                              {"order_id": order_id, "user_id": user.id})
-        await session.execute(text("delete from cart where user_id = :user_id"), {"user_id": user.id})
+async def place_order(user: UserDep, session: SessionDep, idempotency_key: Annotated[Optional[str], Header(max_length=255)] = None):
+    params = {"user_id": user.id, "idempotency_key": idempotency_key}
 
+    try:
+        order = (await session.execute(queries.PLACE_ORDER, params)).first()
         await session.commit()
+        mark_written(user.id)
+    except IntegrityError:
+        # A concurrent request with the same idempotency key created the order first
+        await session.rollback()
+        order = None
+    except DBAPIError as e:
+        await session.rollback()
+        # numeric_value_out_of_range: the total does not fit orders.order_price, the cart is kept
+        if e.orig.sqlstate == "22003":
+            return JSONResponse(status_code=400, content={"message": "Order total is too large"})
+        raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-    return {"message": "Order placed successfully"}
+    if order is None and idempotency_key is not None:
+        order = (await session.execute(queries.FIND_ORDER_BY_IDEMPOTENCY_KEY, params)).first()
+
+    if order is None:
+        return JSONResponse(status_code=400, content={"message": "Cart is empty"})
+
+    return {"message": "Order placed successfully", "order": order._asdict()}
+
+
+PROFILE_UPDATE_BODY = {"requestBody": {"required": True, "content": {
+    "application/json": {"schema": ProfileUpdate.model_json_schema()},
+    "multipart/form-data": {"schema": {"type": "object", "properties": {
+        "email": {"type": "string"}, "fio": {"type": "string"}, "password": {"type": "string"},
+        "avatar": {"type": "string", "format": "binary"}}}},
+}}}
+
+
+@app.patch("/profile", openapi_extra=PROFILE_UPDATE_BODY)
+async def update_profile(request: Request, user: UserDep, session: SessionDep):
+    # A JSON body can only point at an avatar that was uploaded before, a multipart body can upload a new one
+    uploaded_avatar = None
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            fields, uploaded_avatar = await avatars.receive_profile_form(request)
+            profile = ProfileUpdate.model_validate({key: value for key, value in fields.items() if key != "avatar"})
+        else:
+            profile = ProfileUpdate.model_validate_json(await request.body())
+    except avatars.AvatarError as e:
+        return JSONResponse(status_code=e.status_code, content={"message": str(e), "avatar": "Validation error"})
+    except ValidationError as e:
+        raise RequestValidationError(e.errors(include_url=False))
+
+    if uploaded_avatar is not None:
+        profile.avatar = uploaded_avatar
+
+    return await apply_profile_update(profile, user, session)
+
 
+async def apply_profile_update(profile: ProfileUpdate, user: User, session: SessionDep):
+    if profile.avatar is not None and not avatars.is_avatar_url(profile.avatar):
+        return generate_validation_error_for_fields("avatar")
 
-@app.patch("/profile")
-async def update_profile(profile: ProfileUpdate, user: UserDep, session: SessionDep):
     try:
         if profile.avatar is None and profile.email is None and profile.password is None and profile.fio is None:
             return JSONResponse(status_code=400, content={"message": "No input provided"})
@@ -208,8 +382,8 @@ async def update_profile(profile: ProfileUpdate, user: UserDep, session: Session
         if profile.password is not None and profile.password == "":
             return generate_validation_error_for_fields("password")
 
-        if profile.email is not None:
-            await session.execute(text("update users set email = :email where id = :id"), {"email": profile.email, "id": user.id})
+        params = {"id": user.id, "email": profile.email, "avatar": profile.avatar, "set_fio": profile.fio is not None,
+                  "name": None, "surname": None, "middle_name": None, "password_hash": None}
 
         if profile.fio is not None:
             fio = profile.fio.split()
@@ -217,20 +391,24 @@ async def update_profile(profile: ProfileUpdate, user: UserDep, session: Session
             if len(fio) < 2 or len(fio) > 3:
                 return generate_validation_error_for_fields("fio")
 
-            name = fio[0]
-            surname = fio[1]
+            params["name"] = fio[0]
+            params["surname"] = fio[1]
 
             if len(fio) > 2:
-                middle_name = fio[2]
-            else:
-                middle_name = None
-
-            await session.execute(text("update users set name = :name, surname = :surname, middle_name = :middle_name where id = :id"),
-                                  {"name": name, "surname": surname, "middle_name": middle_name, "id": user.id})
-        if profile.avatar:
-            await session.execute(text("update users set avatar = :avatar where id = :id"), {"avatar": profile.avatar, "id": user.id})
+                params["middle_name"] = fio[2]
+
+        if profile.password is not None:
+            params["password_hash"] = await get_password_hash(profile.password)
+
+        await session.execute(queries.UPDATE_PROFILE, params)
+        await events.publish(session, "profile_updated", writer=user.id, user_id=user.id)
         await session.commit()
+        mark_written(user.id)
+        session_cache.invalidate_owner(user.id)
 
+    except HTTPException:
+        await session.rollback()
+        raise
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
@@ -239,16 +417,121 @@ async def update_profile(profile: ProfileUpdate, user: UserDep, session: Session
 
 
 @app.get("/order")
-async def get_order_history(user: UserDep, session: SessionDep):
-    try:
-        order_history = (await session.execute(
-            text("select distinct id, (select array_agg(product_id) from order_items where order_id = orders.id) as products, order_price from orders where user_id = :user_id"),
-            {"user_id": user.id})).all()
+async def get_order_history(user: UserDep, session: ReadSessionDep, limit: Annotated[Optional[int], Query(ge=1, le=500)] = None,
+                            cursor: Optional[str] = None):
+    # Without paging parameters the whole history is returned, as the original API did
+    paged = limit is not None or cursor is not None
+    params = {"user_id": user.id, "limit": (limit or 50) if paged else None}
+
+    if cursor is not None:
+        try:
+            params["before_id"] = int(decode_cursor(cursor, 1)[0])
+        except (ArithmeticError, TypeError, ValueError):
+            return generate_validation_error_for_fields("cursor")
+        if not 0 < params["before_id"] < 2 ** 31:
+            return generate_validation_error_for_fields("cursor")
 
-        return [product._asdict() for product in order_history]
+    try:
+        statement = queries.ORDER_HISTORY_AFTER if cursor is not None else queries.ORDER_HISTORY
+        order_history = (await session.execute(statement, params)).all()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+    if not paged:
+        return ORJSONResponse(order_history)
+
+    next_cursor = encode_cursor([order_history[-1].id]) if len(order_history) == params["limit"] else None
+    return ORJSONResponse({"items": order_history, "next_cursor": next_cursor})
+
+
+class _BatchTransaction:
+    """Session given to the handlers of an atomic batch, the batch commits or rolls back all of their work at once."""
+
+    def __init__(self, session: AsyncSession):
+        self._session = session
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+async def _run_batch_operation(operation, user: User, session):
+    if operation.op == "add_to_cart":
+        return await add_to_cart(operation.product_id, user, session, operation.quantity)
+    if operation.op == "set_cart":
+        return await set_cart_items(operation.items, user, session)
+    if operation.op == "remove_from_cart":
+        return await remove_from_cart(operation.cart_id, user, session)
+    if operation.op == "get_cart":
+        return await get_cart(user, session)
+    if operation.op == "place_order":
+        return await place_order(user, session, operation.idempotency_key)
+    if operation.op == "get_orders":
+        return await get_order_history(user, session, operation.limit, operation.cursor)
+    if operation.op == "get_profile":
+        return get_profile(user, session)
+
+    return await apply_profile_update(ProfileUpdate.model_validate(operation.model_dump(exclude={"op"})), user, session)
+
+
+def _batch_result(response) -> dict:
+    # Handlers that render their own response are embedded as they are, without parsing the JSON again
+    if isinstance(response, Response):
+        return {"status": response.status_code, "body": orjson.Fragment(response.body) if response.body else None}
+
+    return {"status": 200, "body": response}
+
+
+@app.post("/batch")
+async def run_batch(batch: BatchRequest, user: UserDep, session: SessionDep):
+    """Runs cart, order and profile operations in order for one user on one connection.
+
+    Every operation gets the status and body its own endpoint would answer with. An atomic batch runs in one transaction
+    that is rolled back on the first failed operation, the operations after it are not run and get 424.
+    """
+    handler_session = _BatchTransaction(session) if batch.atomic else session
+    results = []
+    failed = False
+
+    for operation in batch.operations:
+        if failed:
+            results.append({"status": 424, "body": {"message": "Not run, an earlier operation failed"}})
+            continue
+
+        try:
+            result = _batch_result(await _run_batch_operation(operation, user, handler_session))
+        except HTTPException as e:
+            result = {"status": e.status_code, "body": {"detail": e.detail}}
+        except Exception as e:
+            await session.rollback()
+            result = {"status": 500, "body": {"detail": str(e)}}
+
+        results.append(result)
+
+        if batch.atomic and result["status"] >= 400:
+            failed = True
+            await session.rollback()
+        elif operation.op == "update_profile" and result["status"] == 200:
+            # Later operations of the batch see the updated profile
+            user = User(*(await session.execute(queries.FIND_USER, {"id": user.id})).one())
+
+    if batch.atomic and not failed:
+        try:
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
+
+        mark_written(user.id)
+        session_cache.invalidate_owner(user.id)
+
+    return ORJSONResponse({"results": results, "committed": not failed})
+
 
 # Module 3
 
@@ -257,20 +540,48 @@ async def create_product(product: Product, user: UserDep, session: SessionDep):
     if not user.is_admin:
         return forbidden
 
-    if math.isinf(product.price) or math.isnan(product.price):
-        return generate_validation_error_for_fields("price")
-    if product.name == "":
-        return generate_validation_error_for_fields("name")
+    invalid_fields = invalid_product_fields(product.name, product.price)
+    if invalid_fields:
+        return generate_validation_error_for_fields(*invalid_fields)
+
+    try:
+        created = (await session.execute(queries.CREATE_PRODUCT, {"name": product.name, "description": product.description, "price": product.price})).one()
+        await publish_product(session, created._asdict(), user.id)
+        await session.commit()
+        mark_written(user.id)
+    except Exception as e:
+        await session.rollback()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    catalog.upsert(created._asdict())
+
+    return {"message": "Product created successfully", "id": created.id}
+
+
+@app.post("/product/import")
+async def import_products_from_file(request: Request, user: UserDep, session: SessionDep):
+    if not user.is_admin:
+        return forbidden
+
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type not in IMPORT_TYPES:
+        return JSONResponse(status_code=415, content={"message": "Content-Type must be text/csv or application/x-ndjson"})
 
     try:
-        product_id = (await session.execute(text("insert into products (name, price, user_id) values (:name, :price, :user_id) returning id"),
-                                            {"name": product.name, "price": product.price, "user_id": user.id})).scalar()
+        result = await import_products(request.stream(), content_type, session)
+        await events.publish(session, "catalog_invalidated", writer=user.id)
         await session.commit()
+        mark_written(user.id)
+    except ImportFormatError as e:
+        await session.rollback()
+        return JSONResponse(status_code=422, content={"message": str(e)})
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        catalog.invalidate()
 
-    return {"message": "Product created successfully", "id": product_id}
+    return {"message": "Products imported successfully", **result}
 
 
 @app.delete("/product/{product_id}")
@@ -279,12 +590,16 @@ async def delete_product(product_id: int, user: UserDep, session: SessionDep):
         return forbidden
 
     try:
-        await session.execute(text("delete from products where id = :id"), {"id": product_id})
+        await session.execute(queries.DELETE_PRODUCT, {"id": product_id})
+        await events.publish(session, "product_removed", writer=user.id, id=product_id)
         await session.commit()
+        mark_written(user.id)
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+    catalog.remove(product_id)
+
     return {"message": "Product deleted successfully"}
 
 
@@ -293,29 +608,99 @@ async def update_product(product_id: int, product: ProductUpdate, user: UserDep,
     if not user.is_admin:
         return forbidden
 
-    if product.name is None and product.name is None or product.price is None:
+    if product.name is None and product.description is None and product.price is None:
         return JSONResponse(status_code=400, content={"message": "No input provided"})
 
-    if product.price is not None and (math.isinf(product.price) or math.isnan(product.price)):
-        return generate_validation_error_for_fields("price")
+    invalid_fields = invalid_product_fields(product.name, product.price)
+    if invalid_fields:
+        return generate_validation_error_for_fields(*invalid_fields)
 
     try:
-        if product.name is not None:
-            await session.execute(text("update products set name = :name where id = :id"), {"name": product.name, "id": product_id})
-        if product.description is not None:
-            await session.execute(text("update products set description = :description where id = :id"), {"description": product.description, "id": product_id})
-        if product.price is not None:
-            await session.execute(text("update products set price = :price where id = :id"), {"price": product.price, "id": product_id})
+        product_data = (await session.execute(queries.UPDATE_PRODUCT, {"name": product.name, "description": product.description,
+                                                                       "price": product.price, "id": product_id})).first()
+        if product_data is not None:
+            await publish_product(session, product_data._asdict(), user.id)
 
         await session.commit()
+        mark_written(user.id)
     except Exception as e:
         await session.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
-    product_data = await session.execute(text("select * from products where id = :id"), {"id": product_id})
-    product_data = product_data.first()
-
     if product_data is None:
         return JSONResponse(status_code=404, content={"message": "Product not found"})
 
+    catalog.upsert(product_data._asdict())
+
     return Product(**product_data._asdict())
+
+
+@app.get("/export/products")
+async def export_products(user: UserDep, format: Literal["ndjson", "csv"] = "ndjson"):
+    if not user.is_admin:
+        return forbidden
+
+    return StreamingResponse(stream_export(EXPORT_PRODUCTS, format), media_type=EXPORT_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="products.{format}"'})
+
+
+@app.get("/export/orders")
+async def export_orders(user: UserDep, format: Literal["ndjson", "csv"] = "ndjson"):
+    if not user.is_admin:
+        return forbidden
+
+    return StreamingResponse(stream_export(EXPORT_ORDERS, format), media_type=EXPORT_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="orders.{format}"'})
+
+
+SALES_REPORT_DAYS = 30
+
+
+def sales_period(date_from: date | None, date_to: date | None) -> dict | None:
+    """Bind parameters of a sales report, the last SALES_REPORT_DAYS UTC days by default; None for a reversed period."""
+    if date_to is None:
+        date_to = datetime.now(timezone.utc).date()
+    if date_from is None:
+        date_from = date_to - timedelta(days=SALES_REPORT_DAYS - 1)
+
+    return {"date_from": date_from, "date_to": date_to} if date_from <= date_to else None
+
+
+@app.get("/admin/sales/daily")
+async def get_daily_sales(user: UserDep, session: ReadSessionDep, date_from: Optional[date] = None, date_to: Optional[date] = None):
+    if not user.is_admin:
+        return forbidden
+
+    period = sales_period(date_from, date_to)
+    if period is None:
+        return generate_validation_error_for_fields("date_from")
+
+    days = (await session.execute(queries.DAILY_SALES, period)).all()
+    return ORJSONResponse({**period, "days": days})
+
+
+@app.get("/admin/sales/top-products")
+async def get_top_products(user: UserDep, session: ReadSessionDep, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                           by: Literal["revenue", "quantity"] = "revenue", limit: Annotated[int, Query(ge=1, le=100)] = 10):
+    if not user.is_admin:
+        return forbidden
+
+    period = sales_period(date_from, date_to)
+    if period is None:
+        return generate_validation_error_for_fields("date_from")
+
+    products = (await session.execute(queries.TOP_PRODUCTS[by], {**period, "limit": limit})).all()
+    return ORJSONResponse({**period, "products": products})
+
+
+@app.get("/admin/sales/basket")
+async def get_basket_size(user: UserDep, session: ReadSessionDep, date_from: Optional[date] = None, date_to: Optional[date] = None):
+    if not user.is_admin:
+        return forbidden
+
+    period = sales_period(date_from, date_to)
+    if period is None:
+        return generate_validation_error_for_fields("date_from")
+
+    basket = (await session.execute(queries.BASKET_SIZE, period)).one()
+    return ORJSONResponse({**period, **basket._asdict()})
@@ -0,0 +1,191 @@
+import asyncio
+import re
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event
+
+# Upper bounds of histogram buckets in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 0.5
+# Longer statements are cut in labels, distinct statements past the limit share one label
+MAX_STATEMENT_LENGTH = 200
+MAX_STATEMENTS = 500
+
+LITERAL = re.compile(r"'(?:[^']|'')*'|(?<![$\w])\d+(?:\.\d+)?\b")
+
+
+class Histogram:
+    """Cumulative histogram of observations keyed by a tuple of label values."""
+
+    __slots__ = ("name", "help", "label_names", "buckets", "series")
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels -> [bucket counts..., +Inf count, sum]
+        self.series: dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self, lines: list[str]):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} histogram")
+
+        for labels, series in self.series.items():
+            prefix = _labels(self.label_names, labels)
+            total = 0
+
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{{{prefix}{',' if prefix else ''}le=\"{le}\"}} {total}")
+
+            braces = f"{{{prefix}}}" if prefix else ""
+            lines.append(f"{self.name}_sum{braces} {series[-1]}")
+            lines.append(f"{self.name}_count{braces} {total}")
+
+
+class Counter:
+    __slots__ = ("name", "help", "label_names", "series")
+
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.series: dict[tuple, int] = {}
+
+    def inc(self, labels: tuple = (), amount: int = 1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self, lines: list[str]):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} counter")
+
+        for labels, value in self.series.items():
+            prefix = _labels(self.label_names, labels)
+            lines.append(f"{self.name}{{{prefix}}} {value}" if prefix else f"{self.name} {value}")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time from the start of a request to the end of its response.", ("method", "route"))
+REQUESTS = Counter("http_requests_total", "Finished requests by status code.", ("method", "route", "status"))
+QUERY_SECONDS = Histogram("db_query_duration_seconds", "Time of one SQL statement on the database connection.", ("statement",))
+POOL_WAIT_SECONDS = Histogram("db_pool_wait_seconds", "Time spent waiting for a connection from the pool.", ("pool",))
+HASHING_SECONDS = Histogram("password_hashing_duration_seconds", "Time of a bcrypt hash or verify including the wait for a worker.", ("operation",))
+LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "How late the event loop runs a callback scheduled every interval.")
+PURGE_BATCH_SECONDS = Histogram("expired_rows_purge_batch_seconds", "Time of one batch delete of expired rows.", ("table",))
+PURGED_ROWS = Counter("expired_rows_purged_total", "Expired rows deleted by the background purge.", ("table",))
+PURGE_ERRORS = Counter("expired_rows_purge_errors_total", "Purge runs that failed.", ("table",))
+EVICTED_SESSIONS = Counter("sessions_evicted_total", "Sessions closed because their user opened more than the allowed number.")
+RATE_LIMITED = Counter("rate_limited_requests_total", "Login and signup attempts rejected by the rate limiter.", ("limit",))
+EVENTS_RECEIVED = Counter("events_received_total", "Change notifications of other workers applied by this worker.", ("kind",))
+
+HISTOGRAMS = [REQUEST_SECONDS, QUERY_SECONDS, POOL_WAIT_SECONDS, HASHING_SECONDS, LOOP_LAG_SECONDS, PURGE_BATCH_SECONDS]
+COUNTERS = [REQUESTS, PURGED_ROWS, PURGE_ERRORS, EVICTED_SESSIONS, RATE_LIMITED, EVENTS_RECEIVED]
+
+_statements: dict[str, str] = {}
+
+
+def normalize_statement(statement: str) -> str:
+    """Collapses whitespace and literals so that one query in a code path always gets the same label."""
+    label = _statements.get(statement)
+    if label is not None:
+        return label
+
+    if len(_statements) >= MAX_STATEMENTS:
+        return "other"
+
+    label = LITERAL.sub("?", " ".join(statement.split()))
+    if len(label) > MAX_STATEMENT_LENGTH:
+        label = label[:MAX_STATEMENT_LENGTH] + "..."
+
+    _statements[statement] = label
+    return label
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    QUERY_SECONDS.observe(time.perf_counter() - context._query_started, (normalize_statement(statement),))
+
+
+def instrument_engine(engine):
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class MetricsMiddleware:
+    """Records latency and status of every HTTP request labelled by its route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the scope, paths with ids would make a label per id
+            route = scope.get("route")
+            labels = (scope["method"], route.path if route is not None else "unmatched")
+
+            REQUEST_SECONDS.observe(time.perf_counter() - started, labels)
+            REQUESTS.inc(labels + (status,))
+
+
+async def sample_loop_lag():
+    loop = asyncio.get_running_loop()
+
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG_SECONDS.observe(max(loop.time() - started - LOOP_LAG_INTERVAL, 0.0))
+
+
+def render(gauges: dict[str, list[tuple[dict, float]]]) -> str:
+    """Prometheus text exposition of all histograms and counters followed by gauges given as name -> [(labels, value)]."""
+    lines = []
+
+    for counter in COUNTERS:
+        counter.render(lines)
+    for histogram in HISTOGRAMS:
+        histogram.render(lines)
+
+    for name, samples in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            prefix = _labels(tuple(labels), tuple(labels.values()))
+            lines.append(f"{name}{{{prefix}}} {value}" if prefix else f"{name} {value}")
+
+    lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,87 @@
+import os
+import re
+import time
+from pathlib import Path
+
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+SOURCE_DIR = Path(__file__).resolve().parent
+ALEMBIC_INI = SOURCE_DIR / "alembic.ini"
+VERSIONS_DIR = SOURCE_DIR / "alembic" / "versions"
+
+# Key of the advisory lock held while migrating, the same in every process that runs migrations
+MIGRATION_LOCK_ID = 716_204_118
+MIGRATION_LOCK_POLL_INTERVAL = 0.5
+
+REVISION = re.compile(r"^revision\b.*?=\s*['\"](\w+)['\"]", re.MULTILINE)
+DOWN_REVISION = re.compile(r"^down_revision\b.*?=(.*)$", re.MULTILINE)
+QUOTED_REVISION = re.compile(r"['\"](\w+)['\"]")
+
+
+class SchemaOutdatedError(RuntimeError):
+    pass
+
+
+def run_migrations():
+    """Upgrades the database to the latest revision; processes started at the same time wait for the first one."""
+    from alembic import command
+    from alembic.config import Config
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import NullPool
+
+    alembic_cfg = Config(str(ALEMBIC_INI))
+
+    dsn = os.getenv('DATABASE_URL')
+    if dsn is not None:
+        alembic_cfg.set_main_option("sqlalchemy.url", dsn.replace('+asyncpg', ''))
+
+    engine = create_engine(alembic_cfg.get_main_option("sqlalchemy.url"), poolclass=NullPool)
+
+    with engine.connect() as connection:
+        # Waiting inside pg_advisory_lock would keep a transaction open, and create index concurrently in the
+        # migrating process waits for every open transaction, so waiting processes poll between short transactions
+        while not connection.execute(text("select pg_try_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID}).scalar():
+            connection.commit()
+            time.sleep(MIGRATION_LOCK_POLL_INTERVAL)
+        connection.commit()
+
+        try:
+            alembic_cfg.attributes["connection"] = connection
+            command.upgrade(alembic_cfg, "head")
+        finally:
+            connection.execute(text("select pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+            connection.commit()
+
+    engine.dispose()
+
+
+def expected_revisions() -> set[str]:
+    """Head revisions of the migration scripts, read from the files so that serving does not import Alembic."""
+    revisions, parents = set(), set()
+
+    for path in VERSIONS_DIR.glob("*.py"):
+        source = path.read_text(encoding="utf-8")
+        revision, down_revision = REVISION.search(source), DOWN_REVISION.search(source)
+
+        if revision is not None:
+            revisions.add(revision.group(1))
+        if down_revision is not None:
+            parents.update(QUOTED_REVISION.findall(down_revision.group(1)))
+
+    return revisions - parents
+
+
+async def check_schema(engine: AsyncEngine):
+    async with engine.connect() as connection:
+        try:
+            current = set((await connection.execute(text("select version_num from alembic_version"))).scalars())
+        except ProgrammingError:
+            current = set()
+
+    expected = expected_revisions()
+    if current != expected:
+        raise SchemaOutdatedError(
+            f"Database schema is at {', '.join(sorted(current)) or 'no revision'}, the code expects {', '.join(sorted(expected))}. "
+            "Run python app.py migrate first")
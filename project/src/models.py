@@ -1,6 +1,6 @@
-from typing import Annotated, Optional
+from typing import Annotated, Literal, Optional, Union
 from typing_extensions import NamedTuple
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
 
 
@@ -53,3 +53,60 @@ class ProductUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
     price: Optional[float] = None
+
+
+# Most of one product a cart can hold, so quantities and the order total stay within their columns
+MAX_CART_QUANTITY = 1000
+
+
+class CartItem(BaseModel):
+    product_id: int
+    quantity: int = Field(ge=0, le=MAX_CART_QUANTITY)
+
+
+class AddToCartOperation(BaseModel):
+    op: Literal["add_to_cart"]
+    product_id: int
+    quantity: int = Field(default=1, ge=1, le=MAX_CART_QUANTITY)
+
+
+class SetCartOperation(BaseModel):
+    op: Literal["set_cart"]
+    items: list[CartItem]
+
+
+class RemoveFromCartOperation(BaseModel):
+    op: Literal["remove_from_cart"]
+    cart_id: int
+
+
+class GetCartOperation(BaseModel):
+    op: Literal["get_cart"]
+
+
+class PlaceOrderOperation(BaseModel):
+    op: Literal["place_order"]
+    idempotency_key: Optional[str] = Field(default=None, max_length=255)
+
+
+class GetOrdersOperation(BaseModel):
+    op: Literal["get_orders"]
+    limit: Optional[int] = Field(default=None, ge=1, le=500)
+    cursor: Optional[str] = None
+
+
+class GetProfileOperation(BaseModel):
+    op: Literal["get_profile"]
+
+
+class UpdateProfileOperation(ProfileUpdate):
+    op: Literal["update_profile"]
+
+
+BatchOperation = Annotated[Union[AddToCartOperation, SetCartOperation, RemoveFromCartOperation, GetCartOperation, PlaceOrderOperation,
+                                 GetOrdersOperation, GetProfileOperation, UpdateProfileOperation], Field(discriminator="op")]
+
+
+class BatchRequest(BaseModel):
+    operations: list[BatchOperation] = Field(min_length=1, max_length=50)
+    atomic: bool = False
@@ -0,0 +1,236 @@
+import codecs
+import csv
+import json
+from decimal import Decimal
+from typing import AsyncIterator
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from catalog import invalid_product_fields
+
+BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 100
+# A quoted field that is never closed would otherwise take the rest of the file into one record
+MAX_RECORD_SIZE = 64 * 1024
+
+CSV_TYPES = {"text/csv", "application/csv"}
+NDJSON_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl", "application/x-jsonlines"}
+SUPPORTED_TYPES = CSV_TYPES | NDJSON_TYPES
+
+STAGING_COLUMNS = ["id", "name", "description", "price"]
+
+CREATE_STAGING_TABLE = (
+    "create temporary table if not exists product_import (id integer, name varchar(255), description text, price decimal(10, 2)) "
+    "on commit drop"
+)
+
+# Rows without an id get a new one from the products sequence, rows with an id replace that product
+MERGE_STAGING_TABLE = (
+    "insert into products (id, name, description, price) "
+    "select coalesce(id, nextval(pg_get_serial_sequence('products', 'id'))), name, description, price from product_import "
+    "on conflict (id) do update set name = excluded.name, description = excluded.description, price = excluded.price"
+)
+
+# Explicit ids may be ahead of the sequence
+SYNC_PRODUCT_SEQUENCE = "select setval(pg_get_serial_sequence('products', 'id'), greatest((select max(id) from products), 1))"
+
+
+class ImportFormatError(Exception):
+    pass
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    tail = ""
+
+    async for chunk in chunks:
+        tail += decoder.decode(chunk)
+        *lines, tail = tail.split("\n")
+
+        for line in lines:
+            yield line.rstrip("\r")
+
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail.rstrip("\r")
+
+
+def _ends_in_quoted_field(line: str, quoted: bool) -> bool:
+    """Whether a quoted field is still open after line, given whether one was open before it.
+
+    As in the csv module, only a quote at the start of a field opens a quoted field, a quote anywhere else is data.
+    """
+    if '"' not in line:
+        return quoted
+
+    field_start = not quoted
+    # A quote inside a quoted field either closes it or is the first half of a doubled quote, the next character tells
+    closing = False
+
+    for char in line:
+        if closing:
+            closing = False
+            if char == '"':
+                continue
+            quoted = False
+
+        if quoted:
+            closing = char == '"'
+        elif char == '"' and field_start:
+            quoted, field_start = True, False
+        else:
+            field_start = char == ","
+
+    return quoted and not closing
+
+
+async def _csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, dict | None]]:
+    header = None
+    lines, record_line, record_size, quoted = [], 0, 0, False
+    line_number = 0
+
+    async for line in _lines(chunks):
+        line_number += 1
+
+        # A quoted field may contain line breaks, the record is complete once no quoted field is open
+        lines.append(line)
+        record_line = record_line or line_number
+        record_size += len(line) + 1
+        quoted = _ends_in_quoted_field(line, quoted)
+
+        if quoted and record_size <= MAX_RECORD_SIZE:
+            continue
+
+        number, record = record_line, "\n".join(lines)
+        lines, record_line, record_size = [], 0, 0
+
+        if quoted:
+            quoted = False
+            if header is None:
+                raise ImportFormatError("CSV header is not closed")
+            yield number, None
+            continue
+
+        values = next(csv.reader([record]))
+
+        if header is None:
+            header = [column.strip().lower() for column in values]
+            if "name" not in header or "price" not in header:
+                raise ImportFormatError("CSV header must contain name and price columns")
+            continue
+
+        if not any(values):
+            continue
+
+        yield number, dict(zip(header, values)) if len(values) == len(header) else None
+
+    if lines:
+        yield record_line, None
+
+    if header is None:
+        raise ImportFormatError("CSV header is missing")
+
+
+async def _ndjson_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, dict | None]]:
+    line_number = 0
+
+    async for line in _lines(chunks):
+        line_number += 1
+        if not line.strip():
+            continue
+
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def _parse_row(row: dict) -> tuple[tuple | None, list[str]]:
+    """Returns the staging record of a row, or the fields that failed validation."""
+    fields = []
+
+    product_id = row.get("id")
+    if product_id in ("", None):
+        product_id = None
+    else:
+        try:
+            product_id = int(product_id)
+        except (TypeError, ValueError):
+            product_id = None
+            fields.append("id")
+        else:
+            if not 0 < product_id < 2 ** 31:
+                fields.append("id")
+
+    name = row.get("name")
+    if not isinstance(name, str):
+        name = "" if name is None else str(name)
+
+    description = row.get("description")
+    if not isinstance(description, str):
+        description = "" if description is None else str(description)
+
+    try:
+        price = float(row.get("price"))
+    except (TypeError, ValueError):
+        price = None
+        fields.append("price")
+
+    # Postgres text can not hold NUL, COPY would fail the whole import on it
+    if "\x00" in name:
+        fields.append("name")
+    if "\x00" in description:
+        fields.append("description")
+
+    fields.extend(field for field in invalid_product_fields(name.strip(), price) if field not in fields)
+    if fields:
+        return None, fields
+
+    return (product_id, name.strip(), description, Decimal(str(price)).quantize(Decimal("0.01"))), []
+
+
+async def _copy_batch(session: AsyncSession, batch: dict):
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+
+    await raw_connection.driver_connection.copy_records_to_table("product_import", records=list(batch.values()), columns=STAGING_COLUMNS)
+    await session.execute(text(MERGE_STAGING_TABLE))
+    await session.execute(text("truncate product_import"))
+
+
+async def import_products(chunks: AsyncIterator[bytes], content_type: str, session: AsyncSession) -> dict:
+    """Streams rows from chunks into products in batches; the whole import is one transaction committed by the caller."""
+    rows = _csv_rows(chunks) if content_type in CSV_TYPES else _ndjson_rows(chunks)
+
+    await session.execute(text(CREATE_STAGING_TABLE))
+
+    imported, failed = 0, 0
+    errors = []
+    # Products without an id are keyed by their line so that only rows with the same id replace each other within a batch
+    batch = {}
+
+    async for line_number, row in rows:
+        record, fields = _parse_row(row) if row is not None else (None, ["row"])
+
+        if record is None:
+            failed += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"line": line_number, "fields": fields})
+            continue
+
+        batch[record[0] if record[0] is not None else -line_number] = record
+        if len(batch) >= BATCH_SIZE:
+            await _copy_batch(session, batch)
+            imported += len(batch)
+            batch = {}
+
+    if batch:
+        await _copy_batch(session, batch)
+        imported += len(batch)
+
+    await session.execute(text(SYNC_PRODUCT_SEQUENCE))
+
+    return {"imported": imported, "failed": failed, "errors": errors}
@@ -0,0 +1,153 @@
+from sqlalchemy import JSON, text
+
+from catalog import PRODUCT_COLUMNS
+
+# Statements of the API handlers. They are built once at import: parsing the SQL of a text() construct costs
+# more than executing a short statement from the compiled cache, so handlers never create them per request.
+
+# A new user starts with one session, so signup needs neither the session limit of login nor a second commit
+CREATE_USER_WITH_SESSION = text(
+    "with new_user as (insert into users (name, surname, middle_name, email, password_hash) "
+    "values (:name, :surname, :middle_name, :email, :password_hash) returning id), "
+    "opened as (insert into sessions (user_id, token, expires_at) select id, :token, :expires_at from new_user) "
+    "select id from new_user"
+)
+
+FIND_USER = text("select * from users where id = :id")
+
+FIND_USER_BY_EMAIL = text("select * from users where email = :email")
+
+# Sessions from before signed tokens keep a random token, which is looked up on every request that misses the cache
+FIND_USER_BY_LEGACY_TOKEN = text(
+    "select users.* from users right join sessions on users.id = sessions.user_id "
+    "where sessions.token = :token and sessions.expires_at > now()"
+)
+
+# Inserts the session and closes the ones past the per-user limit in one statement; the subquery does not see
+# the new row, so it keeps one session less. Signed tokens are checked without the sessions table, so closed ones are revoked
+OPEN_SESSION = text(
+    "with opened as (insert into sessions (user_id, token, expires_at) values (:user_id, :token, :expires_at)), "
+    "evicted as (delete from sessions where id in (select id from sessions where user_id = :user_id order by id desc offset :keep_sessions) "
+    "returning token, expires_at), "
+    "revoked as (insert into revoked_tokens (jti, expires_at) select token, expires_at from evicted where token not like '$2%' "
+    "on conflict do nothing) "
+    "select token, expires_at from evicted"
+)
+
+CLOSE_LEGACY_SESSION = text("delete from sessions where token = :token returning user_id")
+
+REVOKE_TOKEN = text("insert into revoked_tokens (jti, expires_at) values (:jti, :expires_at) on conflict do nothing")
+
+CLOSE_SESSION = text("delete from sessions where token = :jti")
+
+REVOKED_TOKENS = text("select jti, expires_at from revoked_tokens where expires_at > now()")
+
+# Fields passed as null keep their value; fio sets the whole name, so a name without a middle name clears it
+UPDATE_PROFILE = text(
+    "update users set email = coalesce(:email, email), name = coalesce(:name, name), surname = coalesce(:surname, surname), "
+    "middle_name = case when :set_fio then :middle_name else middle_name end, password_hash = coalesce(:password_hash, password_hash), "
+    "profile_picture = coalesce(:avatar, profile_picture) where id = :id returning *"
+)
+
+ADD_TO_CART = text(
+    "insert into cart (user_id, product_id, quantity) values (:user_id, :product_id, :quantity) "
+    "on conflict (user_id, product_id) do update set quantity = cart.quantity + excluded.quantity "
+    "where cart.quantity + excluded.quantity <= :max_quantity"
+)
+
+# Sets the quantity of every given product in one statement, a zero quantity removes the product from the cart
+SET_CART_ITEMS = text(
+    "with input as (select product_id, quantity from unnest(cast(:product_ids as integer[]), cast(:quantities as integer[])) as t(product_id, quantity)), "
+    "removed as (delete from cart using input where cart.user_id = :user_id and cart.product_id = input.product_id and input.quantity = 0) "
+    "insert into cart (user_id, product_id, quantity) select :user_id, product_id, quantity from input where quantity > 0 "
+    "on conflict (user_id, product_id) do update set quantity = excluded.quantity"
+)
+
+REMOVE_FROM_CART = text("delete from cart where user_id = :user_id and id = :id")
+
+CART_ITEMS = text(
+    "select cart.id, cart.product_id, cart.quantity, products.name, products.description, products.price from cart "
+    "inner join products on cart.product_id = products.id where cart.user_id = :user_id"
+)
+
+# sales_daily has several rows per day and an order adds to the row of this expression of its id
+SALES_SHARD = "id % 16"
+# Sales are summarized by UTC day, the backfill uses the same expression
+SALES_DAY = "cast(created_at at time zone 'UTC' as date)"
+
+ORDER_ITEMS_JSON = "json_agg(json_build_object('product_id', product_id, 'name', name, 'unit_price', unit_price, 'quantity', quantity) order by id)"
+
+# Checkout in one statement: the cart is moved into a new order unless the idempotency key was already used,
+# in which case the order created by the first attempt is returned. A new order is added to the sales summaries
+# in the same statement, so they change exactly when the order is committed; product rows are upserted in
+# product id order, so two orders never wait for each other's rows in opposite order.
+PLACE_ORDER = text(
+    "with existing as (select id, order_price from orders where user_id = :user_id and idempotency_key = :idempotency_key), "
+    "removed as (delete from cart where user_id = :user_id and not exists (select 1 from existing) returning product_id, quantity), "
+    "priced as (select removed.product_id, removed.quantity, products.name, products.price "
+    "from removed inner join products on removed.product_id = products.id), "
+    "new_order as (insert into orders (user_id, order_price, idempotency_key) "
+    f"select :user_id, sum(price * quantity), :idempotency_key from priced having count(*) > 0 returning id, order_price, {SALES_DAY} as day), "
+    "items as (insert into order_items (order_id, product_id, name, unit_price, quantity) "
+    "select new_order.id, priced.product_id, priced.name, priced.price, priced.quantity from new_order, priced "
+    "returning id, product_id, name, unit_price, quantity), "
+    "daily as (insert into sales_daily as daily (day, shard, orders, items, revenue) "
+    f"select day, {SALES_SHARD}, 1, (select sum(quantity) from priced), order_price from new_order "
+    "on conflict (day, shard) do update set orders = daily.orders + excluded.orders, items = daily.items + excluded.items, "
+    "revenue = daily.revenue + excluded.revenue), "
+    "product_daily as (insert into product_sales_daily as sales (day, product_id, name, quantity, revenue) "
+    "select new_order.day, priced.product_id, priced.name, priced.quantity, priced.price * priced.quantity from new_order, priced "
+    "order by priced.product_id "
+    "on conflict (day, product_id) do update set name = excluded.name, quantity = sales.quantity + excluded.quantity, "
+    "revenue = sales.revenue + excluded.revenue) "
+    f"select id, order_price, (select {ORDER_ITEMS_JSON} from items) as items from new_order "
+    "union all "
+    f"select id, order_price, (select {ORDER_ITEMS_JSON} from order_items where order_id = existing.id) from existing"
+).columns(items=JSON)
+
+FIND_ORDER_BY_IDEMPOTENCY_KEY = text(
+    f"select id, order_price, (select {ORDER_ITEMS_JSON} from order_items where order_id = orders.id) as items "
+    "from orders where user_id = :user_id and idempotency_key = :idempotency_key"
+).columns(items=JSON)
+
+# Newest orders first, each page continues below the last order id of the previous one
+ORDER_HISTORY = text(
+    f"select orders.id, orders.order_price, (select {ORDER_ITEMS_JSON} from order_items where order_id = orders.id) as items "
+    "from orders where orders.user_id = :user_id order by orders.id desc limit :limit"
+).columns(items=JSON)
+
+ORDER_HISTORY_AFTER = text(
+    f"select orders.id, orders.order_price, (select {ORDER_ITEMS_JSON} from order_items where order_id = orders.id) as items "
+    "from orders where orders.user_id = :user_id and orders.id < :before_id order by orders.id desc limit :limit"
+).columns(items=JSON)
+
+CREATE_PRODUCT = text(f"insert into products (name, description, price) values (:name, :description, :price) returning {PRODUCT_COLUMNS}")
+
+DELETE_PRODUCT = text("delete from products where id = :id")
+
+UPDATE_PRODUCT = text(
+    "update products set name = coalesce(:name, name), description = coalesce(:description, description), price = coalesce(:price, price) "
+    f"where id = :id returning {PRODUCT_COLUMNS}"
+)
+
+# Sales analytics read only the summaries, never orders and order_items
+DAILY_SALES = text(
+    "select day, sum(orders) as orders, cast(sum(items) as bigint) as items, sum(revenue) as revenue, round(sum(revenue) / sum(orders), 2) as average_basket "
+    "from sales_daily where day between :date_from and :date_to group by day order by day"
+)
+
+BASKET_SIZE = text(
+    "select coalesce(sum(orders), 0) as orders, cast(coalesce(sum(items), 0) as bigint) as items, coalesce(sum(revenue), 0) as revenue, "
+    "round(sum(revenue) / nullif(sum(orders), 0), 2) as average_price, round(sum(items) / nullif(sum(orders), 0), 2) as average_items "
+    "from sales_daily where day between :date_from and :date_to"
+)
+
+PRODUCT_SALES = (
+    "select product_id, (array_agg(name order by day desc))[1] as name, cast(sum(quantity) as bigint) as quantity, sum(revenue) as revenue "
+    "from product_sales_daily where day between :date_from and :date_to group by product_id"
+)
+
+TOP_PRODUCTS = {
+    "revenue": text(PRODUCT_SALES + " order by revenue desc, product_id limit :limit"),
+    "quantity": text(PRODUCT_SALES + " order by quantity desc, product_id limit :limit"),
+}
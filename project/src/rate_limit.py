@@ -0,0 +1,164 @@
+import ipaddress
+import logging
+import math
+import os
+import time
+
+from fastapi import HTTPException, Request, status
+from sqlalchemy import text
+
+from database import async_session, env_flag
+import metrics
+
+RATE_LIMIT_IP_BURST = int(os.getenv("RATE_LIMIT_IP_BURST", "30"))
+RATE_LIMIT_IP_PER_MINUTE = float(os.getenv("RATE_LIMIT_IP_PER_MINUTE", "30"))
+RATE_LIMIT_EMAIL_BURST = int(os.getenv("RATE_LIMIT_EMAIL_BURST", "5"))
+RATE_LIMIT_EMAIL_PER_MINUTE = float(os.getenv("RATE_LIMIT_EMAIL_PER_MINUTE", "2"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Keeps the buckets in Postgres, so that the limits hold across all workers and instances
+RATE_LIMIT_SHARED = env_flag("RATE_LIMIT_SHARED", False)
+
+MAX_KEY_LENGTH = 254
+
+# Takes a token only when the refilled bucket has one; a rejected attempt gets the wait from the row as it was
+TAKE_SHARED_TOKEN = (
+    "with bucket as (select least(cast(:burst as double precision), tokens + extract(epoch from now() - updated_at) * cast(:rate as double precision)) "
+    "as tokens from rate_limit_buckets where key = :key), "
+    "taken as (insert into rate_limit_buckets as stored (key, tokens, updated_at, expires_at) "
+    "values (:key, :burst - 1, now(), now() + :refill_seconds * interval '1 second') "
+    "on conflict (key) do update set tokens = least(:burst, stored.tokens + extract(epoch from now() - stored.updated_at) * :rate) - 1, "
+    "updated_at = now(), expires_at = excluded.expires_at "
+    "where least(:burst, stored.tokens + extract(epoch from now() - stored.updated_at) * :rate) >= 1 returning key) "
+    "select exists (select from taken) as taken, (select (1 - tokens) / :rate from bucket) as retry_after"
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBuckets:
+    """Token buckets of one limit, keyed by a client address or an email.
+
+    A bucket holds up to burst tokens, refills at per_minute tokens a minute and every attempt takes one token.
+    Only the token count and the time of the last attempt are kept per key, and a bucket that has refilled completely
+    is the same as no bucket at all, so it is dropped.
+    """
+
+    def __init__(self, name: str, burst: int, per_minute: float, max_keys: int):
+        self.name = name
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.max_keys = max_keys
+        self.evictions = 0
+        # Ordered by the last attempt, so the buckets that have refilled are always at the front
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.burst > 0 and self.rate > 0
+
+    @property
+    def refill_seconds(self) -> float:
+        return self.burst / self.rate
+
+    def take(self, key: str, now: float | None = None) -> float:
+        """Takes a token of key and returns 0, or returns the seconds left until the bucket has a token again."""
+        if now is None:
+            now = time.monotonic()
+
+        self.sweep(now)
+
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+        self._buckets[key] = (tokens - 1, now)
+
+        # Past the limit the least recently used bucket is forgotten, which only resets the limit of that key
+        if len(self._buckets) > self.max_keys:
+            del self._buckets[next(iter(self._buckets))]
+            self.evictions += 1
+
+        return 0.0
+
+    def sweep(self, now: float):
+        """Drops the buckets that have refilled since their last attempt."""
+        idle_since = now - self.refill_seconds
+
+        while self._buckets:
+            key = next(iter(self._buckets))
+            if self._buckets[key][1] > idle_since:
+                break
+            del self._buckets[key]
+
+    async def take_shared(self, key: str) -> float:
+        params = {"key": f"{self.name}:{key}", "burst": self.burst, "rate": self.rate, "refill_seconds": self.refill_seconds}
+
+        async with async_session() as session:
+            row = (await session.execute(text(TAKE_SHARED_TOKEN), params)).one()
+            await session.commit()
+
+        if row.taken:
+            return 0.0
+
+        return row.retry_after if row.retry_after is not None else 1 / self.rate
+
+    def stats(self):
+        return {"buckets": len(self._buckets), "max_keys": self.max_keys, "evictions": self.evictions}
+
+
+by_address = TokenBuckets("address", RATE_LIMIT_IP_BURST, RATE_LIMIT_IP_PER_MINUTE, RATE_LIMIT_MAX_KEYS)
+by_email = TokenBuckets("email", RATE_LIMIT_EMAIL_BURST, RATE_LIMIT_EMAIL_PER_MINUTE, RATE_LIMIT_MAX_KEYS)
+
+
+def client_key(request: Request) -> str:
+    host = request.client.host if request.client else "unknown"
+
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return host[:MAX_KEY_LENGTH]
+
+    if address.version == 4:
+        return str(address)
+    if address.ipv4_mapped is not None:
+        return str(address.ipv4_mapped)
+
+    # One IPv6 client usually owns the whole /64
+    return str(ipaddress.ip_network(f"{address}/64", strict=False))
+
+
+async def _take(buckets: TokenBuckets, key: str) -> float:
+    if RATE_LIMIT_SHARED:
+        try:
+            return await buckets.take_shared(key)
+        except Exception:
+            logger.warning("Could not take a shared rate limit token, limiting this worker only", exc_info=True)
+
+    return buckets.take(key)
+
+
+async def check(request: Request, email: str | None = None):
+    """Rejects a login or signup attempt over the limit of its client address or email with 429.
+
+    It runs before the password is hashed or checked, so rejected attempts do not cost any bcrypt work.
+    """
+    checks = [(by_address, client_key(request))]
+    if email:
+        checks.append((by_email, email.strip().lower()[:MAX_KEY_LENGTH]))
+
+    for buckets, key in checks:
+        if not buckets.enabled:
+            continue
+
+        retry_after = await _take(buckets, key)
+        if retry_after > 0:
+            metrics.RATE_LIMITED.inc((buckets.name,))
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many attempts, try again later",
+                                headers={"Retry-After": str(max(math.ceil(retry_after), 1))})
+
+
+def stats():
+    return {buckets.name: buckets.stats() for buckets in (by_address, by_email)}
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+
+from sqlalchemy import text
+
+from database import engine
+from queries import SALES_DAY
+
+SALES_BACKFILL_BATCH_SIZE = int(os.getenv("SALES_BACKFILL_BATCH_SIZE", "10000"))
+# Pause between batches, so rebuilding a long history does not keep the database busy for checkouts
+SALES_BACKFILL_PAUSE = float(os.getenv("SALES_BACKFILL_PAUSE", "0.05"))
+
+# Key of the advisory lock held while backfilling, so two backfills never share the rebuild tables
+BACKFILL_LOCK_ID = 716_204_119
+
+# A checkout that is still running holds a lock conflicting with share mode, so once the lock is granted every order
+# up to the returned id is committed or rolled back, and orders placed later get a larger id
+LOCK_ORDERS = "lock table orders in share mode"
+LAST_ORDER_ID = "select coalesce(max(id), 0) from orders"
+
+CLEAR_REBUILD = "truncate sales_daily_rebuild, product_sales_daily_rebuild"
+
+# Orders in (after_id, last_id] are added to the rebuild tables; the range is repeated for order_items,
+# because the planner does not carry it over the join and would read the whole table for every batch
+REBUILD_STATEMENTS = {
+    "sales_daily_rebuild": (
+        "insert into sales_daily_rebuild as daily (day, orders, items, revenue) "
+        f"select {SALES_DAY} as day, count(*), coalesce(sum(items.quantity), 0), sum(orders.order_price) from orders "
+        "left join lateral (select sum(quantity) as quantity from order_items where order_id = orders.id) items on true "
+        "where orders.id > :after_id and orders.id <= :last_id group by day "
+        "on conflict (day) do update set orders = daily.orders + excluded.orders, items = daily.items + excluded.items, "
+        "revenue = daily.revenue + excluded.revenue"
+    ),
+    "product_sales_daily_rebuild": (
+        "insert into product_sales_daily_rebuild as sales (day, product_id, name, quantity, revenue) "
+        f"select {SALES_DAY} as day, order_items.product_id, (array_agg(order_items.name order by order_items.id desc))[1], "
+        "sum(order_items.quantity), sum(order_items.unit_price * order_items.quantity) from orders "
+        "inner join order_items on order_items.order_id = orders.id "
+        "where orders.id > :after_id and orders.id <= :last_id and order_items.order_id > :after_id and order_items.order_id <= :last_id "
+        "and order_items.product_id is not null group by day, order_items.product_id "
+        "on conflict (day, product_id) do update set name = excluded.name, quantity = sales.quantity + excluded.quantity, "
+        "revenue = sales.revenue + excluded.revenue"
+    ),
+}
+
+# Checkouts wait for the exclusive lock instead of adding to summaries that are being replaced, reads go on
+LOCK_SUMMARIES = "lock table sales_daily, product_sales_daily in exclusive mode"
+
+# Run in this order in the transaction holding LOCK_SUMMARIES. Items of a deleted product lose its id, so the history
+# can not rebuild its sales and the rows the summary already has are kept; they win over rows of a product deleted mid-backfill
+SWAP_STATEMENTS = {
+    "clear sales_daily": "delete from sales_daily",
+    "clear product_sales_daily": "delete from product_sales_daily where product_id in (select id from products)",
+    "fill sales_daily": "insert into sales_daily (day, shard, orders, items, revenue) select day, 0, orders, items, revenue from sales_daily_rebuild",
+    "fill product_sales_daily": (
+        "insert into product_sales_daily (day, product_id, name, quantity, revenue) "
+        "select day, product_id, name, quantity, revenue from product_sales_daily_rebuild on conflict (day, product_id) do nothing"
+    ),
+}
+
+logger = logging.getLogger(__name__)
+
+
+class BackfillRunningError(RuntimeError):
+    pass
+
+
+async def backfill():
+    """Rebuilds the sales summaries from the order history.
+
+    History is aggregated in batches of SALES_BACKFILL_BATCH_SIZE orders, each in its own transaction, into the rebuild
+    tables, while checkouts keep adding to the current summaries. Orders placed in the meantime are added at the end,
+    in the transaction that replaces the summaries.
+    """
+    async with engine.connect() as connection:
+        if not (await connection.execute(text("select pg_try_advisory_lock(:id)"), {"id": BACKFILL_LOCK_ID})).scalar():
+            await connection.rollback()
+            raise BackfillRunningError("Another sales backfill is running")
+        await connection.commit()
+
+        try:
+            await connection.execute(text(CLEAR_REBUILD))
+            await connection.execute(text(LOCK_ORDERS))
+            last_id = (await connection.execute(text(LAST_ORDER_ID))).scalar()
+            await connection.commit()
+
+            logger.info("Summarizing orders up to id %d", last_id)
+
+            for after_id in range(0, last_id, SALES_BACKFILL_BATCH_SIZE):
+                params = {"after_id": after_id, "last_id": min(after_id + SALES_BACKFILL_BATCH_SIZE, last_id)}
+                for table in REBUILD_STATEMENTS:
+                    await connection.execute(text(REBUILD_STATEMENTS[table]), params)
+                await connection.commit()
+
+                logger.info("Summarized orders up to id %d", params["last_id"])
+                await asyncio.sleep(SALES_BACKFILL_PAUSE)
+
+            await connection.execute(text(LOCK_SUMMARIES))
+            for table in REBUILD_STATEMENTS:
+                await connection.execute(text(REBUILD_STATEMENTS[table]), {"after_id": last_id, "last_id": 2 ** 31 - 1})
+            for step in SWAP_STATEMENTS:
+                await connection.execute(text(SWAP_STATEMENTS[step]))
+            await connection.execute(text(CLEAR_REBUILD))
+            await connection.commit()
+        finally:
+            await connection.rollback()
+            await connection.execute(text("select pg_advisory_unlock(:id)"), {"id": BACKFILL_LOCK_ID})
+            await connection.commit()
+
+    logger.info("Rebuilt the sales summaries")
@@ -0,0 +1,31 @@
+from decimal import Decimal
+from typing import Any
+
+import orjson
+from sqlalchemy.engine import Row
+from starlette.responses import JSONResponse
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, Row):
+        return value._asdict()
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dump_json(content) -> bytes:
+    """Compact UTF-8 JSON; result rows, prices and dates are written directly without converting the content first."""
+    return orjson.dumps(content, default=_default)
+
+
+class ORJSONResponse(JSONResponse):
+    """Response class of the app.
+
+    FastAPI runs the return value of a handler through jsonable_encoder before rendering it, so list handlers
+    return this response themselves with the rows as they came from the database.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dump_json(content)
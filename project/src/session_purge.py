@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+import time
+
+from sqlalchemy import text
+
+from database import async_session
+import metrics
+
+SESSION_PURGE_INTERVAL = float(os.getenv("SESSION_PURGE_INTERVAL", "300"))
+SESSION_PURGE_BATCH_SIZE = int(os.getenv("SESSION_PURGE_BATCH_SIZE", "1000"))
+# Pause between batches, so a large backlog is deleted in many short transactions instead of one long one
+SESSION_PURGE_PAUSE = float(os.getenv("SESSION_PURGE_PAUSE", "0.05"))
+
+# Rows locked by another worker purging at the same time are skipped
+PURGE_STATEMENTS = {
+    "sessions": (
+        "delete from sessions where id in (select id from sessions where expires_at <= now() "
+        "order by expires_at limit :batch_size for update skip locked)"
+    ),
+    "revoked_tokens": (
+        "delete from revoked_tokens where jti in (select jti from revoked_tokens where expires_at <= now() "
+        "order by expires_at limit :batch_size for update skip locked)"
+    ),
+    "rate_limit_buckets": (
+        "delete from rate_limit_buckets where key in (select key from rate_limit_buckets where expires_at <= now() "
+        "order by expires_at limit :batch_size for update skip locked)"
+    ),
+}
+
+logger = logging.getLogger(__name__)
+
+_last_run = 0.0
+
+
+async def purge_table(table: str) -> int:
+    purged = 0
+
+    while True:
+        started = time.perf_counter()
+
+        async with async_session() as session:
+            deleted = (await session.execute(text(PURGE_STATEMENTS[table]), {"batch_size": SESSION_PURGE_BATCH_SIZE})).rowcount
+            await session.commit()
+
+        metrics.PURGE_BATCH_SECONDS.observe(time.perf_counter() - started, (table,))
+        metrics.PURGED_ROWS.inc((table,), deleted)
+        purged += deleted
+
+        if deleted < SESSION_PURGE_BATCH_SIZE:
+            return purged
+
+        await asyncio.sleep(SESSION_PURGE_PAUSE)
+
+
+async def run_purge():
+    """Deletes expired sessions, revoked tokens and refilled rate limit buckets every SESSION_PURGE_INTERVAL seconds until cancelled."""
+    global _last_run
+
+    while True:
+        for table in PURGE_STATEMENTS:
+            try:
+                purged = await purge_table(table)
+            except Exception:
+                metrics.PURGE_ERRORS.inc((table,))
+                logger.exception("Could not purge expired rows from %s", table)
+            else:
+                if purged:
+                    logger.info("Purged %d expired rows from %s", purged, table)
+
+        _last_run = time.time()
+        await asyncio.sleep(SESSION_PURGE_INTERVAL)
+
+
+def stats():
+    return {"last_run_timestamp_seconds": _last_run}